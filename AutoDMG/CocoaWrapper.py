@@ -27,6 +27,7 @@ from Foundation import (
     NSDateFormatterLongStyle,
     NSDefaultRunLoopMode,
     NSDictionary,
+    NSError,
     NSErrorFailingURLStringKey,
     NSFileHandle,
     NSFileHandleNotificationDataItem,
@@ -35,12 +36,14 @@ from Foundation import (
     NSIndexSet,
     NSLocale,
     NSLocaleLanguageCode,
+    NSLocalizedDescriptionKey,
     NSLog,
     NSMakeRange,
     NSMakeSize,
     NSMutableArray,
     NSMutableData,
     NSMutableDictionary,
+    NSMutableURLRequest,
     NSNotFound,
     NSNotificationCenter,
     NSObject,
@@ -58,7 +61,14 @@ from Foundation import (
     NSURLBookmarkResolutionWithoutMounting,
     NSURLBookmarkResolutionWithoutUI,
     NSURLConnection,
+    NSURLErrorBadURL,
+    NSURLErrorCancelled,
+    NSURLErrorCannotParseResponse,
+    NSURLErrorDomain,
+    NSURLErrorUnsupportedURL,
+    NSURLErrorUserAuthenticationRequired,
     NSURLRequest,
+    NSURLRequestReloadIgnoringLocalCacheData,
     NSURLResponseUnknownLength,
     NSURLVolumeURLKey,
     NSUserDefaults,
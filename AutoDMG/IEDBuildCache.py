@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDBuildCache.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import os
+import errno
+import shutil
+import hashlib
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+from IEDUtil import *
+
+
+class IEDBuildCache(NSObject):
+    """Keep the images of earlier builds, so a build with exactly the same
+    inputs can reuse the image instead of installing everything again.
+    
+    Images are stored in the directory set by BuildCachePath (the cache is
+    disabled if it's empty) as <key>.dmg, next to a <key>.plist with the
+    sha1 and size of the image. The key is a sha1 of everything that goes
+    into a build, see keyForInputs_. At most BuildCacheMaxImages images are
+    kept, the least recently used are removed first."""
+    
+    def init(self):
+        self = super(IEDBuildCache, self).init()
+        if self is None:
+            return None
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        path = defaults.stringForKey_("BuildCachePath")
+        self.path = os.path.expanduser(path) if path else None
+        self.maxImages = max(1, defaults.integerForKey_("BuildCacheMaxImages"))
+        
+        return self
+    
+    def isEnabled(self):
+        return bool(self.path)
+    
+    def imagePathForKey_(self, key):
+        return os.path.join(self.path, "%s.dmg" % key)
+    
+    def infoPathForKey_(self, key):
+        return os.path.join(self.path, "%s.plist" % key)
+    
+    # Build keys.
+    
+    def keyForInputs_(self, inputs):
+        """Return the key for a list of strings describing a build, in
+        order."""
+        
+        checksum = hashlib.sha1()
+        for item in inputs:
+            checksum.update(item.encode("utf-8"))
+            checksum.update(b"\0")
+        return checksum.hexdigest()
+    
+    def identityForPackage_(self, package):
+        """Return a string that changes when the contents of a package
+        change. Updates are identified by their sha1, other flat files are
+        hashed, and bundles are identified by the paths, sizes and
+        modification times of their contents."""
+        
+        if package.sha1():
+            return package.sha1()
+        path = package.path()
+        if os.path.isfile(path):
+            return IEDUtil.sha1ForFile_(path)
+        checksum = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                itemPath = os.path.join(dirpath, name)
+                st = os.lstat(itemPath)
+                checksum.update(("%s %d %d\n" % (os.path.relpath(itemPath, path),
+                                                 st.st_size,
+                                                 int(st.st_mtime))).encode("utf-8"))
+        return "bundle:%s" % checksum.hexdigest()
+    
+    def identityForTemplateAtPath_(self, path):
+        """Return a string that changes when any setting in a saved template
+        changes. The template is copied into the image, so an image built
+        from other settings can't be reused even if the rest is the same."""
+        
+        return "template:%s" % IEDUtil.sha1ForFile_(path)
+    
+    # Images.
+    
+    def lookupKey_(self, key):
+        """Return the path to the image for key if there is one and its sha1
+        matches, otherwise None. Images that fail verification are
+        removed."""
+        
+        imagePath = self.imagePathForKey_(key)
+        info = NSDictionary.dictionaryWithContentsOfFile_(self.infoPathForKey_(key))
+        if not info or not os.path.exists(imagePath):
+            return None
+        if os.path.getsize(imagePath) != info["Size"]:
+            LogWarning("Cached image %@ has the wrong size, removing", imagePath)
+            self.removeKey_(key)
+            return None
+        sha1 = IEDUtil.sha1ForFile_(imagePath)
+        if sha1 != info["SHA1"]:
+            LogWarning("Cached image %@ has sha1 %@, expected %@, removing", imagePath, sha1, info["SHA1"])
+            self.removeKey_(key)
+            return None
+        # Mark it as recently used.
+        os.utime(self.infoPathForKey_(key), None)
+        return imagePath
+    
+    def storeImage_forKey_(self, imagePath, key):
+        """Add a built image to the cache. Returns an error message, or None
+        on success."""
+        
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            cachedPath = self.imagePathForKey_(key)
+            self.linkOrCopy_toPath_(imagePath, cachedPath)
+            info = NSMutableDictionary.dictionary()
+            info["SHA1"] = IEDUtil.sha1ForFile_(cachedPath)
+            info["Size"] = os.path.getsize(cachedPath)
+            info["Date"] = NSDate.date()
+            if not info.writeToFile_atomically_(self.infoPathForKey_(key), True):
+                self.removeKey_(key)
+                return "Couldn't write %s" % self.infoPathForKey_(key)
+        except (IOError, OSError) as e:
+            self.removeKey_(key)
+            return "Couldn't store %s in build cache: %s" % (imagePath, unicode(e))
+        LogInfo("Stored %@ in build cache as %@", imagePath, key)
+        self.prune()
+        return None
+    
+    def linkOrCopy_toPath_(self, sourcePath, destPath):
+        """Hardlink sourcePath to destPath, or copy it if the filesystem
+        doesn't allow it. destPath is replaced if it exists."""
+        
+        if os.path.exists(destPath):
+            os.unlink(destPath)
+        try:
+            os.link(sourcePath, destPath)
+        except OSError as e:
+            if e.errno not in IEDUtil.LINK_FALLBACK_ERRNOS:
+                raise
+            shutil.copyfile(sourcePath, destPath)
+    
+    def removeKey_(self, key):
+        for path in (self.imagePathForKey_(key), self.infoPathForKey_(key)):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    LogWarning("Can't remove %@: %@", path, unicode(e))
+    
+    def prune(self):
+        keys = list()
+        for name in os.listdir(self.path):
+            key, ext = os.path.splitext(name)
+            if ext == ".plist":
+                keys.append((os.path.getmtime(os.path.join(self.path, name)), key))
+        keys.sort(reverse=True)
+        for mtime, key in keys[self.maxImages:]:
+            LogInfo("Removing %@ from build cache", key)
+            self.removeKey_(key)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDBuildETA.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import time
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+
+
+class IEDBuildETA(NSObject):
+    """Estimate the remaining time of a build from the progress of its
+    phases.
+    
+    Every phase starts out with a prior duration, the expectedSeconds
+    learned from earlier builds or, for phases that haven't been seen
+    before, its weight divided by the rate of the phases that have. As a
+    phase makes progress its observed rate is smoothed into the prior, and
+    phases that have finished scale the priors of the remaining ones."""
+    
+    # Weight per second for phases without history when no phase has any,
+    # weights are roughly bytes.
+    DEFAULT_RATE = 8.0 * 1024 * 1024
+    # Smoothing factor for the observed rate of a phase.
+    ALPHA = 0.2
+    # Limits for how much finished phases can scale the remaining priors.
+    MIN_SCALE = 0.5
+    MAX_SCALE = 2.0
+    
+    def initWithPhases_(self, phases):
+        self = super(IEDBuildETA, self).init()
+        if self is None:
+            return None
+        
+        known = list(phase for phase in phases if phase.get("expectedSeconds"))
+        knownSeconds = sum(phase["expectedSeconds"] for phase in known)
+        if knownSeconds:
+            rate = sum(phase["weight"] for phase in known) / knownSeconds
+        else:
+            rate = IEDBuildETA.DEFAULT_RATE
+        # Pair phases by identity, as several of them share a title.
+        self.priors = list((phase, phase.get("expectedSeconds") or phase["weight"] / rate) for phase in phases)
+        self.priorSeconds = 0.0
+        self.actualSeconds = 0.0
+        self.phase = None
+        self.phasePrior = 0.0
+        self.phaseStartTime = 0.0
+        self.rate = None
+        self.lastFraction = 0.0
+        self.lastTime = 0.0
+        self.throughput = 0.0
+        
+        return self
+    
+    def startPhase_(self, phase):
+        now = time.time()
+        if self.phase is not None:
+            self.priorSeconds += self.phasePrior
+            self.actualSeconds += now - self.phaseStartTime
+        self.phasePrior = 0.0
+        for index, (candidate, prior) in enumerate(self.priors):
+            if candidate is phase:
+                self.phasePrior = prior
+                # Phases before this one were skipped or already finished.
+                del self.priors[:index + 1]
+                break
+        self.phase = phase
+        self.phaseStartTime = now
+        self.rate = 1.0 / self.phasePrior if self.phasePrior else None
+        self.lastFraction = 0.0
+        self.lastTime = now
+        self.throughput = 0.0
+    
+    def updateFraction_(self, fraction):
+        """Update the progress of the current phase, from 0.0 to 1.0."""
+        
+        now = time.time()
+        elapsed = now - self.lastTime
+        if elapsed <= 0.0 or fraction <= self.lastFraction:
+            return
+        observed = (fraction - self.lastFraction) / elapsed
+        if self.rate is None:
+            self.rate = observed
+        else:
+            self.rate = IEDBuildETA.ALPHA * observed + (1.0 - IEDBuildETA.ALPHA) * self.rate
+        self.throughput = self.rate * self.phase["weight"]
+        self.lastFraction = fraction
+        self.lastTime = now
+    
+    def scale(self):
+        if not self.priorSeconds:
+            return 1.0
+        return min(IEDBuildETA.MAX_SCALE, max(IEDBuildETA.MIN_SCALE, self.actualSeconds / self.priorSeconds))
+    
+    def remainingSeconds(self):
+        """Return the estimated number of seconds until the build finishes,
+        or None before the first phase has started."""
+        
+        if self.phase is None:
+            return None
+        scale = self.scale()
+        if self.rate:
+            phaseRemaining = (1.0 - self.lastFraction) / self.rate - (time.time() - self.lastTime)
+        else:
+            phaseRemaining = self.phasePrior * scale - (time.time() - self.phaseStartTime)
+        return max(0.0, phaseRemaining) + scale * sum(prior for phase, prior in self.priors)
+    
+    def bytesPerSecond(self):
+        """Return the smoothed weight per second of the current phase, which
+        is roughly bytes per second for install and convert phases."""
+        
+        return self.throughput
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDBuildTelemetry.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import os
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+
+
+class IEDBuildTelemetry(NSObject):
+    """Record how long builds take, for estimates of future builds.
+    
+    Builds are kept in BuildTelemetry.plist in the application support
+    directory, newest last. Each build has a list of Phases with the Key,
+    Title, Seconds and, for phases that install a package, Bytes of every
+    phase, which is used to weigh the phases of the progress bar."""
+    
+    MAX_BUILDS = 50
+    # Number of recent samples of a phase used to predict its duration.
+    PHASE_SAMPLES = 10
+    # Key of the phases that install a package, which are fitted by size.
+    PACKAGE_PHASE_KEY = "Installing package"
+    
+    def init(self):
+        self = super(IEDBuildTelemetry, self).init()
+        if self is None:
+            return None
+        
+        fm = NSFileManager.defaultManager()
+        url, error = fm.URLForDirectory_inDomain_appropriateForURL_create_error_(NSApplicationSupportDirectory,
+                                                                                 NSUserDomainMask,
+                                                                                 None,
+                                                                                 True,
+                                                                                 None)
+        self.path = os.path.join(url.path(), "AutoDMG", "BuildTelemetry.plist")
+        self.builds = list()
+        # Recent samples of each phase key, estimates for every profile use
+        # the same ones.
+        self.phasePoints = dict()
+        plist = NSDictionary.dictionaryWithContentsOfFile_(self.path)
+        if plist:
+            self.builds = list(dict(build) for build in plist.get("Builds", list()))
+        
+        return self
+    
+    def recordBuild_(self, build):
+        """Add a build, a dictionary with at least Seconds and Phases, and
+        save the store."""
+        
+        build = dict(build)
+        build["Date"] = NSDate.date()
+        self.builds.append(build)
+        del self.builds[:-self.MAX_BUILDS]
+        self.phasePoints = dict()
+        plist = NSMutableDictionary.dictionary()
+        plist["Builds"] = list(NSDictionary.dictionaryWithDictionary_(x) for x in self.builds)
+        if not plist.writeToFile_atomically_(self.path, True):
+            LogWarning("Failed to write %@", self.path)
+    
+    def estimateSecondsForUpdateSizes_(self, sizes):
+        """Estimate the duration of a build that installs updates of sizes,
+        from the phase timings of earlier builds. That is the median time of
+        the phases that don't install a package, plus the fitted duration of
+        the install phase of each update, so additional packages don't
+        count. Returns None without any history."""
+        
+        overheads = sorted(sum(phase["Seconds"] for phase in build["Phases"]
+                               if phase["Key"] != self.PACKAGE_PHASE_KEY)
+                           for build in self.builds[-self.PHASE_SAMPLES:] if build.get("Phases"))
+        if not overheads:
+            return None
+        seconds = overheads[len(overheads) // 2]
+        for size in sizes:
+            seconds += self.estimateSecondsForPhase_bytes_(self.PACKAGE_PHASE_KEY, size) or 0.0
+        return seconds
+    
+    def estimateSecondsForPhase_bytes_(self, key, size):
+        """Estimate the duration of a phase from its most recent samples.
+        Phases that install a package are fitted against its size. Returns
+        None if the phase hasn't been seen before."""
+        
+        points = self.phasePointsForKey_(key)
+        if not points:
+            return None
+        if size is None:
+            # Use the median, so a single slow build doesn't skew the weights.
+            seconds = sorted(y for x, y in points)
+            return seconds[len(seconds) // 2]
+        return self.fitPoints_x_(points, size)
+    
+    def learnWeightsForPhases_(self, phases):
+        """Replace the estimated weights of phases with weights derived from
+        earlier builds, and set the expectedSeconds of every phase that has
+        been seen before.
+        
+        Weights are in bytes, so learned durations are scaled by the ratio
+        of estimated weight to duration of the phases with history, and
+        phases without history keep their estimated weight."""
+        
+        known = list()
+        for phase in phases:
+            seconds = self.estimateSecondsForPhase_bytes_(phase["key"], phase.get("bytes"))
+            if seconds is not None:
+                phase["expectedSeconds"] = seconds
+                known.append(phase)
+        knownSeconds = sum(phase["expectedSeconds"] for phase in known)
+        if not knownSeconds:
+            return
+        bytesPerSecond = sum(phase["weight"] for phase in known) / knownSeconds
+        for phase in known:
+            # Keep a minimal weight so no phase is invisible.
+            phase["weight"] = max(1024 * 1024, int(phase["expectedSeconds"] * bytesPerSecond))
+        LogInfo("Learned weights for %d of %d phases from %d builds", len(known), len(phases), len(self.builds))
+    
+    def phasePointsForKey_(self, key):
+        """Return (bytes, seconds) tuples for the most recent samples of a
+        phase."""
+        
+        if key not in self.phasePoints:
+            points = list()
+            for build in reversed(self.builds):
+                for phase in build.get("Phases", list()):
+                    if phase["Key"] == key:
+                        points.append((float(phase.get("Bytes", 0)), float(phase["Seconds"])))
+                if len(points) >= self.PHASE_SAMPLES:
+                    break
+            self.phasePoints[key] = points[:self.PHASE_SAMPLES]
+        return self.phasePoints[key]
+    
+    def fitPoints_x_(self, points, x0):
+        """Least squares fit of points, a list of (x, y) tuples, evaluated at
+        x0. Falls back to the mean if y doesn't grow with x. Returns None
+        without any points."""
+        
+        if not points:
+            return None
+        n = len(points)
+        meanX = sum(x for x, y in points) / n
+        meanY = sum(y for x, y in points) / n
+        varX = sum((x - meanX) ** 2 for x, y in points)
+        if varX == 0.0:
+            return meanY
+        slope = sum((x - meanX) * (y - meanY) for x, y in points) / varX
+        if slope < 0.0:
+            # Too noisy to say anything about package size.
+            return meanY
+        return max(0.0, meanY + slope * (x0 - meanX))
@@ -13,8 +13,12 @@ from CocoaWrapper import *
 from Collaboration import CBIdentity, CBIdentityAuthority
 
 import os
+import re
 import sys
+import time
 import getpass
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
 from IEDUpdateCache import *
 from IEDProfileController import *
@@ -43,19 +47,29 @@ class IEDCLIController(NSObject):
         self.profileController = IEDProfileController.alloc().init()
         self.profileController.awakeFromNib()
         self.profileController.setDelegate_(self)
-        self.cache.pruneAndCreateSymlinks(self.profileController.updatePaths)
+        self.cache.pruneIncrementally_publicationDate_(self.profileController.updatePaths,
+                                                       self.profileController.publicationDate)
         
         self.busy = False
+        self.examinedSource = None
         
         self.progressMax = 1.0
+        self.remainingSeconds = None
+        self.bytesPerSecond = 0.0
         self.lastMessage = ""
+        self.lastDownloadPercent = dict()
+        self.lastDownloadTimestamp = dict()
+        self.downloadRetries = 0
         
         self.hasFailed = False
+        self.failureMessages = list()
         
         return self
     
     def listVerbs(self):
-        return list(item[3:].rstrip("_").lower() for item in dir(self) if item.startswith("cmd"))
+        # cmdImportUpdates_ becomes import-updates.
+        return list(re.sub(r"(?<=[a-z])([A-Z])", r"-\1", item[3:].rstrip("_")).lower()
+                    for item in dir(self) if item.startswith("cmd"))
     
     def cleanup(self):
         self.workflow.cleanup()
@@ -72,6 +86,7 @@ class IEDCLIController(NSObject):
     
     def failWithMessage_(self, message):
         LogError("%@", message)
+        self.failureMessages.append(message)
         self.hasFailed = True
         self.busy = False
     
@@ -83,6 +98,9 @@ class IEDCLIController(NSObject):
         
         # Parse arguments.
         
+        if args.rate_limit is not None:
+            self.cache.setRateLimit_(args.rate_limit)
+        
         sourcePath = IEDUtil.installESDPath_(args.source) or \
                         IEDUtil.systemImagePath_(args.source)
         if sourcePath:
@@ -129,20 +147,38 @@ class IEDCLIController(NSObject):
             self.failWithMessage_("No output path")
             return os.EX_USAGE
         
-        LogNotice("Installer: %@", template.sourcePath)
+        return self.buildTemplate_downloadUpdates_force_(template, args.download_updates, args.force)
+    
+    def examineSource_(self, sourcePath):
+        """Set the source, unless it was examined by the previous build.
+        Returns False if the source couldn't be examined."""
         
-        # Set the source.
+        if sourcePath == self.examinedSource:
+            LogInfo("Reusing source %@", sourcePath)
+            return True
+        self.examinedSource = None
         self.busy = True
-        self.workflow.setSource_(template.sourcePath)
+        self.workflow.setSource_(sourcePath)
         self.waitBusy()
         if self.hasFailed:
-            return os.EX_DATAERR
-        
+            return False
+        self.examinedSource = sourcePath
+        return True
+    
+    def resolveVariablesInTemplate_(self, template):
         template.resolveVariables_({
             "OSNAME":      self.installerName,
             "OSVERSION":   self.installerVersion,
             "OSBUILD":     self.installerBuild,
         })
+    
+    def buildTemplate_downloadUpdates_force_(self, template, downloadUpdates, force):
+        LogNotice("Installer: %@", template.sourcePath)
+        
+        if not self.examineSource_(template.sourcePath):
+            return os.EX_DATAERR
+        
+        self.resolveVariablesInTemplate_(template)
         
         LogNotice("Output Path: %@", template.outputPath)
         LogNotice("Volume Name: %@", template.volumeName)
@@ -156,6 +192,13 @@ class IEDCLIController(NSObject):
                                                                                            self.installerBuild))
                 return os.EX_DATAERR
             
+            summary = self.profileController.summaryForVersion_build_cache_(self.installerVersion,
+                                                                            self.installerBuild,
+                                                                            self.cache)
+            LogNotice("%d update%@ (%@, %@)", summary["updateCount"], "" if summary["updateCount"] == 1 else "s",
+                      IEDUtil.formatByteSize_(summary["totalBytes"]),
+                      self.profileController.summaryDescription_(summary))
+            
             missingUpdates = list()
             
             for update in profile:
@@ -167,7 +210,7 @@ class IEDCLIController(NSObject):
                 package.setUrl_(update["url"])
                 package.setSha1_(update["sha1"])
                 if not self.cache.isCached_(update["sha1"]):
-                    if args.download_updates:
+                    if downloadUpdates:
                         missingUpdates.append(package)
                     else:
                         self.failWithMessage_("Can't apply updates, %s is missing from cache" % update["name"])
@@ -181,7 +224,6 @@ class IEDCLIController(NSObject):
                 if self.hasFailed:
                     self.failWithMessage_("Can't build due to updates missing from cache")
                     return 1    # EXIT_FAILURE
-                updates.extend(missingUpdates)
                 LogNotice("All updates for %@ %@ downloaded", self.installerVersion, self.installerBuild)
         
         # Generate the list of additional packages to install.
@@ -191,7 +233,7 @@ class IEDCLIController(NSObject):
         
         # Check the output path.
         if os.path.exists(template.outputPath):
-            if args.force:
+            if force:
                 try:
                     os.unlink(template.outputPath)
                 except OSError as e:
@@ -209,21 +251,12 @@ class IEDCLIController(NSObject):
                     self.failWithMessage_("%s does not exist and can't be created: %s" % (outputDir, str(e)))
                     return os.EX_CANTCREAT
         
-        # If we're not running as root get the password for authentication.
-        if os.getuid() != 0:
-            username = NSUserName()
-            currentUser = CBIdentity.identityWithName_authority_(username, CBIdentityAuthority.defaultIdentityAuthority())
-            passwordOK = False
-            while not passwordOK:
-                password = getpass.getpass("Password for %s: " % username).decode("utf-8")
-                if currentUser.authenticateWithPassword_(password):
-                    passwordOK = True
-            self.workflow.setAuthUsername_(username)
-            self.workflow.setAuthPassword_(password)
+        self.authenticate()
         
         # Start the workflow.
         self.busy = True
         self.workflow.setPackagesToInstall_(updates + template.packagesToInstall)
+        self.cache.markPackagesUsed_(updates)
         self.workflow.setOutputPath_(template.outputPath)
         self.workflow.setVolumeName_(template.volumeName)
         self.workflow.setVolumeSize_(template.volumeSize)
@@ -237,6 +270,20 @@ class IEDCLIController(NSObject):
         
         return os.EX_OK
     
+    def authenticate(self):
+        # If we're not running as root get the password for authentication,
+        # once per process.
+        if os.getuid() != 0 and not self.workflow.authPassword():
+            username = NSUserName()
+            currentUser = CBIdentity.identityWithName_authority_(username, CBIdentityAuthority.defaultIdentityAuthority())
+            passwordOK = False
+            while not passwordOK:
+                password = getpass.getpass("Password for %s: " % username).decode("utf-8")
+                if currentUser.authenticateWithPassword_(password):
+                    passwordOK = True
+            self.workflow.setAuthUsername_(username)
+            self.workflow.setAuthPassword_(password)
+    
     def checkTemplate_(self, path):
         path = IEDUtil.resolvePath_(path)
         if not path:
@@ -259,10 +306,113 @@ class IEDCLIController(NSObject):
         argparser.add_argument("-U", "--download-updates", action="store_true", help="Download missing updates")
         argparser.add_argument("-f", "--force", action="store_true", help="Overwrite output")
         argparser.add_argument("-F", "--filesystem", choices=["apfs", "hfs"], help="Filesystem for 10.13 images")
+        argparser.add_argument("--rate-limit", type=int, metavar="BYTES", help="Limit update downloads to BYTES per second")
         argparser.add_argument("packages", nargs="*", help="Additional packages")
     
     
     
+    # Build a batch of images.
+    
+    def cmdBuildBatch_(self, args):
+        """Build images from several templates"""
+        
+        if args.rate_limit is not None:
+            self.cache.setRateLimit_(args.rate_limit)
+        
+        # Load all templates before building anything, so a typo doesn't
+        # fail the batch halfway through.
+        templates = list()
+        for path in args.templates:
+            templatePath = self.checkTemplate_(path)
+            if not templatePath:
+                self.failWithMessage_("'%s' is not an AutoDMG template" % path)
+                return os.EX_DATAERR
+            template = IEDTemplate.alloc().init()
+            error = template.loadTemplateAndReturnError_(templatePath)
+            if error:
+                self.failWithMessage_("Couldn't load template from '%s': %s" % (templatePath, error))
+                return os.EX_DATAERR
+            if args.skip_asr_imagescan:
+                template.setFinalizeAsrImagescan_(False)
+            if not template.sourcePath:
+                self.failWithMessage_("No source path in %s" % templatePath)
+                return os.EX_USAGE
+            if not template.outputPath:
+                self.failWithMessage_("No output path in %s" % templatePath)
+                return os.EX_USAGE
+            templates.append((templatePath, template))
+        
+        # Build templates that share an installer one after another, so each
+        # source is only examined once. The sort is stable, so the order is
+        # otherwise kept.
+        templates.sort(key=lambda item: item[1].sourcePath)
+        
+        # Output paths can refer to the installer version, so resolve the
+        # variables of every template before checking that the outputs
+        # differ. Sources are examined in reverse, so the first build can
+        # reuse the last one. A source that fails is reported by its build.
+        for templatePath, template in reversed(templates):
+            if self.examineSource_(template.sourcePath):
+                self.resolveVariablesInTemplate_(template)
+            else:
+                self.hasFailed = False
+                self.failureMessages = list()
+        outputPaths = dict()
+        for templatePath, template in templates:
+            if template.outputPath in outputPaths:
+                self.failWithMessage_("%s and %s both build %s" % (outputPaths[template.outputPath],
+                                                                   templatePath,
+                                                                   template.outputPath))
+                return os.EX_USAGE
+            outputPaths[template.outputPath] = templatePath
+        
+        results = list()
+        for index, (templatePath, template) in enumerate(templates):
+            LogNotice("Building %@ (%d of %d)", templatePath, index + 1, len(templates))
+            self.hasFailed = False
+            self.failureMessages = list()
+            startTime = time.time()
+            status = self.buildTemplate_downloadUpdates_force_(template, args.download_updates, args.force)
+            if status != os.EX_OK:
+                # Examine the source again for the next template.
+                self.examinedSource = None
+            results.append({
+                "Template": templatePath,
+                "Installer": template.sourcePath,
+                "OutputPath": template.outputPath,
+                "ExitStatus": status,
+                "Succeeded": status == os.EX_OK,
+                "Seconds": time.time() - startTime,
+                "Errors": self.failureMessages,
+            })
+        
+        failed = list(result["Template"] for result in results if not result["Succeeded"])
+        LogNotice("%d of %d builds succeeded", len(results) - len(failed), len(results))
+        for templatePath in failed:
+            LogNotice("    Failed: %@", templatePath)
+        
+        if args.summary:
+            summary = NSMutableDictionary.dictionary()
+            summary["Builds"] = list(NSDictionary.dictionaryWithDictionary_(result) for result in results)
+            if not summary.writeToFile_atomically_(args.summary, True):
+                self.failWithMessage_("Couldn't write summary to %s" % args.summary)
+                return os.EX_CANTCREAT
+        
+        if failed:
+            return 1    # EXIT_FAILURE
+        
+        return os.EX_OK
+    
+    def addargsBuildBatch_(self, argparser):
+        argparser.add_argument("templates", nargs="+", help="AutoDMG templates")
+        argparser.add_argument("--summary", metavar="PATH", help="Write a plist with the result of each build to PATH")
+        argparser.add_argument("--skip-asr-imagescan", action="store_true", help="Skip `asr imagescan` (Scan for Restore) phase")
+        argparser.add_argument("-U", "--download-updates", action="store_true", help="Download missing updates")
+        argparser.add_argument("-f", "--force", action="store_true", help="Overwrite output")
+        argparser.add_argument("--rate-limit", type=int, metavar="BYTES", help="Limit update downloads to BYTES per second")
+    
+    
+    
     # List updates.
     
     def cmdList_(self, args):
@@ -273,7 +423,11 @@ class IEDCLIController(NSObject):
             self.failWithMessage_(self.profileController.whyNoProfileForVersion_build_(args.version, args.build))
             return os.EX_DATAERR
         
-        LogNotice("%d update%@ for %@ %@:", len(profile), "" if len(profile) == 1 else "s", args.version, args.build)
+        summary = self.profileController.summaryForVersion_build_cache_(args.version, args.build, self.cache)
+        LogNotice("%d update%@ for %@ %@ (%@, %@):", len(profile), "" if len(profile) == 1 else "s",
+                  args.version, args.build,
+                  IEDUtil.formatByteSize_(summary["totalBytes"]),
+                  self.profileController.summaryDescription_(summary))
         for update in profile:
             LogNotice("    %@%@ (%@)",
                       "[cached] " if self.cache.isCached_(update["sha1"]) else "",
@@ -293,6 +447,9 @@ class IEDCLIController(NSObject):
     def cmdDownload_(self, args):
         """Download updates"""
         
+        if args.rate_limit is not None:
+            self.cache.setRateLimit_(args.rate_limit)
+        
         profile = self.profileController.profileForVersion_Build_(args.version, args.build)
         if profile is None:
             self.failWithMessage_(self.profileController.whyNoProfileForVersion_build_(args.version, args.build))
@@ -324,6 +481,244 @@ class IEDCLIController(NSObject):
     def addargsDownload_(self, argparser):
         argparser.add_argument("version", help="OS X version")
         argparser.add_argument("build", help="OS X build")
+        argparser.add_argument("--rate-limit", type=int, metavar="BYTES", help="Limit downloads to BYTES per second")
+    
+    
+    
+    # Prefetch updates for every build of an OS version.
+    
+    def cmdPrefetch_(self, args):
+        """Download updates for all builds of an OS version"""
+        
+        if args.rate_limit is not None:
+            self.cache.setRateLimit_(args.rate_limit)
+        
+        # Collect the union of updates from every matching profile, as most
+        # updates are shared between builds.
+        names = self.profileController.profileNamesForVersion_(args.version)
+        if not names:
+            self.failWithMessage_("No profiles for %s" % args.version)
+            return os.EX_DATAERR
+        LogNotice("%d profile%@ for %@: %@", len(names), "" if len(names) == 1 else "s",
+                  args.version, ", ".join(names))
+        wanted = dict()
+        for name in names:
+            for update in self.profileController.profiles[name]:
+                wanted[update["sha1"]] = update
+        
+        updates = list()
+        for sha1, update in wanted.iteritems():
+            if not self.cache.isCached_(sha1):
+                package = IEDPackage.alloc().init()
+                package.setName_(update["name"])
+                package.setPath_(self.cache.updatePath_(sha1))
+                package.setSize_(update["size"])
+                package.setUrl_(update["url"])
+                package.setSha1_(sha1)
+                updates.append(package)
+        
+        totalSize = sum(package.size() for package in updates)
+        LogNotice("%d of %d update%@ missing from cache (%@)",
+                  len(updates), len(wanted), "" if len(wanted) == 1 else "s",
+                  IEDUtil.formatByteSize_(totalSize))
+        if not updates:
+            return os.EX_OK
+        expected = self.cache.expectedDownloadTime_(totalSize)
+        if expected is not None:
+            expected = int(expected)
+            LogNotice("Expected download time is %d:%02d:%02d",
+                      expected // 3600, expected // 60 % 60, expected % 60)
+        
+        self.cache.downloadUpdates_(updates)
+        self.busy = True
+        self.waitBusy()
+        
+        if self.hasFailed:
+            return 1    # EXIT_FAILURE
+        
+        LogNotice("All updates for %@ downloaded", args.version)
+        
+        return os.EX_OK
+    
+    def addargsPrefetch_(self, argparser):
+        argparser.add_argument("version", help="OS X version, e.g. 10.13 or 10.13.6")
+        argparser.add_argument("--rate-limit", type=int, metavar="BYTES", help="Limit downloads to BYTES per second")
+    
+    
+    
+    # Import updates from a local directory.
+    
+    def cmdImportUpdates_(self, args):
+        """Import updates from a local directory"""
+        
+        if not os.path.isdir(args.directory):
+            self.failWithMessage_("%s is not a directory" % args.directory)
+            return os.EX_NOINPUT
+        
+        # Collect the updates that are missing from the cache, and the sizes
+        # to look for, so that only plausible files have to be hashed.
+        wanted = dict()
+        for profile in self.profileController.profiles.itervalues():
+            for update in profile:
+                if not self.cache.isCached_(update["sha1"]):
+                    wanted[update["sha1"].lower()] = update
+        if not wanted:
+            LogNotice("All updates are already cached")
+            return os.EX_OK
+        sizes = set(update["size"] for update in wanted.itervalues())
+        
+        candidates = list()
+        for dirpath, dirnames, filenames in os.walk(args.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.isfile(path) and os.path.getsize(path) in sizes:
+                        candidates.append(path)
+                except OSError as e:
+                    LogWarning("Skipping %@: %@", path, str(e))
+        LogNotice("Hashing %d candidate file%@ for %d missing update%@",
+                  len(candidates), "" if len(candidates) == 1 else "s",
+                  len(wanted), "" if len(wanted) == 1 else "s")
+        
+        def hashCandidate(path):
+            try:
+                return path, IEDUtil.sha1ForFile_(path), None
+            except (IOError, OSError) as e:
+                return path, None, str(e)
+        
+        # hashlib releases the GIL while hashing, so threads are enough to
+        # keep several disks or a network volume busy.
+        startTime = time.time()
+        bytesHashed = 0
+        imported = 0
+        pool = ThreadPool(max(1, args.jobs))
+        try:
+            for path, sha1, error in pool.imap_unordered(hashCandidate, candidates):
+                if error:
+                    LogWarning("Couldn't read %@: %@", path, error)
+                    continue
+                bytesHashed += os.path.getsize(path)
+                update = wanted.pop(sha1, None)
+                if update is None:
+                    LogDebug("%@ doesn't match any missing update", path)
+                    continue
+                if self.cache.importFile_sha1_(path, update["sha1"]):
+                    LogNotice("Imported %@", update["name"])
+                    imported += 1
+                else:
+                    self.hasFailed = True
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - startTime
+        if elapsed > 0.0:
+            LogInfo("Hashed %@ in %.1f seconds (%@/s)",
+                    IEDUtil.formatByteSize_(bytesHashed),
+                    elapsed,
+                    IEDUtil.formatByteSize_(bytesHashed / elapsed))
+        
+        if imported:
+            self.cache.pruneAndCreateSymlinks(self.profileController.updatePaths)
+        LogNotice("Imported %d update%@, %d still missing",
+                  imported, "" if imported == 1 else "s", len(wanted))
+        
+        if self.hasFailed:
+            return 1    # EXIT_FAILURE
+        
+        return os.EX_OK
+    
+    def addargsImportUpdates_(self, argparser):
+        argparser.add_argument("-j", "--jobs", type=int, default=4, help="Number of files to hash in parallel")
+        argparser.add_argument("directory", help="Directory with update packages")
+    
+    
+    
+    # Verify cached updates.
+    
+    def cmdVerifyCache_(self, args):
+        """Verify checksums of cached updates"""
+        
+        sha1s = self.cache.cachedSha1s()
+        if not sha1s:
+            LogNotice("Update cache is empty")
+            return os.EX_OK
+        LogNotice("Verifying %d cached update%@ with %d thread%@",
+                  len(sha1s), "" if len(sha1s) == 1 else "s",
+                  args.jobs, "" if args.jobs == 1 else "s")
+        
+        def hashCached(sha1):
+            try:
+                return sha1, IEDUtil.sha1ForFile_(self.cache.cachePath_(sha1)), None
+            except (IOError, OSError) as e:
+                return sha1, None, str(e)
+        
+        startTime = time.time()
+        bytesHashed = 0
+        damaged = 0
+        pool = ThreadPool(max(1, args.jobs))
+        try:
+            for sha1, checksum, error in pool.imap_unordered(hashCached, sha1s):
+                name = self.cache.symlinks.get(sha1, sha1)
+                if error:
+                    self.failWithMessage_("Couldn't read %s: %s" % (name, error))
+                    continue
+                bytesHashed += os.path.getsize(self.cache.cachePath_(sha1))
+                if checksum == sha1.lower():
+                    LogInfo("%@ OK", name)
+                    self.cache.indexFile_verified_(sha1, True)
+                    continue
+                LogError("%@ is damaged, sha1 is %@", name, checksum)
+                damaged += 1
+                self.hasFailed = True
+                try:
+                    self.cache.quarantine_(sha1)
+                except OSError as e:
+                    self.failWithMessage_("Couldn't quarantine %s: %s" % (name, str(e)))
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - startTime
+        
+        self.cache.saveIndex()
+        if damaged:
+            # Remove the links to the quarantined files.
+            self.cache.pruneAndCreateSymlinks(self.profileController.updatePaths)
+        
+        LogNotice("Verified %@ in %.1f seconds (%@/s), %d damaged",
+                  IEDUtil.formatByteSize_(bytesHashed),
+                  elapsed,
+                  IEDUtil.formatByteSize_(bytesHashed / elapsed if elapsed > 0.0 else 0),
+                  damaged)
+        
+        if self.hasFailed:
+            return 1    # EXIT_FAILURE
+        
+        return os.EX_OK
+    
+    def addargsVerifyCache_(self, argparser):
+        argparser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                               help="Number of files to hash in parallel")
+    
+    
+    
+    # Prune the update cache.
+    
+    def cmdPrune_(self, args):
+        """Prune the update cache"""
+        
+        if args.dry_run:
+            reclaimed, removed = self.cache.pruneDryRun_(self.profileController.updatePaths)
+            for item in sorted(removed):
+                LogNotice("Would remove %@", item)
+            LogNotice("Pruning would reclaim %@", IEDUtil.formatByteSize_(reclaimed))
+        else:
+            self.cache.pruneAndCreateSymlinks(self.profileController.updatePaths)
+        
+        return os.EX_OK
+    
+    def addargsPrune_(self, argparser):
+        argparser.add_argument("-n", "--dry-run", action="store_true",
+                               help="Report what would be removed without removing anything")
     
     
     
@@ -378,6 +773,8 @@ class IEDCLIController(NSObject):
     def buildStartingWithOutput_(self, outputPath):
         self.busy = True
         self.lastProgressPercent = -100.0
+        self.remainingSeconds = None
+        self.bytesPerSecond = 0.0
     
     def buildSetTotalWeight_(self, totalWeight):
         self.progressMax = totalWeight
@@ -388,9 +785,21 @@ class IEDCLIController(NSObject):
     def buildSetProgress_(self, progress):
         percent = 100.0 * progress / self.progressMax
         if abs(percent - self.lastProgressPercent) >= 0.1:
-            LogInfo("progress: %.1f%%", percent)
+            if self.remainingSeconds is None:
+                LogInfo("progress: %.1f%%", percent)
+            elif self.bytesPerSecond:
+                LogInfo("progress: %.1f%%, ~%@ remaining, %@/s", percent,
+                        IEDUtil.formatDuration_(self.remainingSeconds),
+                        IEDUtil.formatByteSize_(self.bytesPerSecond))
+            else:
+                LogInfo("progress: %.1f%%, ~%@ remaining", percent,
+                        IEDUtil.formatDuration_(self.remainingSeconds))
             self.lastProgressPercent = percent
     
+    def buildSetRemainingSeconds_throughput_(self, seconds, bytesPerSecond):
+        self.remainingSeconds = seconds
+        self.bytesPerSecond = bytesPerSecond
+    
     def buildSetProgressMessage_(self, message):
         if message != self.lastMessage:
             LogInfo("message: %@", message)
@@ -412,12 +821,14 @@ class IEDCLIController(NSObject):
     
     def downloadAllDone(self):
         LogDebug("downloadAllDone")
+        if self.downloadRetries:
+            LogNotice("Downloads needed %d retr%@", self.downloadRetries, "y" if self.downloadRetries == 1 else "ies")
         self.busy = False
     
     def downloadStarting_(self, package):
         LogNotice("Downloading %@ (%@)", package.name(), IEDUtil.formatByteSize_(package.size()))
-        self.lastProgressPercent = -100.0
-        self.lastProgressTimestamp = NSDate.alloc().init()
+        self.lastDownloadPercent[package.sha1()] = -100.0
+        self.lastDownloadTimestamp[package.sha1()] = NSDate.alloc().init()
     
     def downloadStarted_(self, package):
         LogDebug("downloadStarted:")
@@ -425,22 +836,34 @@ class IEDCLIController(NSObject):
     def downloadStopped_(self, package):
         LogDebug("downloadStopped:")
     
+    def downloadPaused_(self, package):
+        LogDebug("downloadPaused:")
+    
     def downloadGotData_bytesRead_(self, package, bytes):
         percent = 100.0 * float(bytes) / float(package.size())
         # Log progress if we've downloaded more than 10%, more than one second
-        # has passed, or if we're at 100%.
-        if (abs(percent - self.lastProgressPercent) >= 10.0) or \
-           (abs(self.lastProgressTimestamp.timeIntervalSinceNow()) >= 1.0) or \
+        # has passed, or if we're at 100%. Downloads run in parallel so the
+        # progress is tracked per package.
+        sha1 = package.sha1()
+        if (abs(percent - self.lastDownloadPercent[sha1]) >= 10.0) or \
+           (abs(self.lastDownloadTimestamp[sha1].timeIntervalSinceNow()) >= 1.0) or \
            (bytes == package.size()):
-            LogInfo("progress: %.1f%%", percent)
-            self.lastProgressPercent = percent
-            self.lastProgressTimestamp = NSDate.alloc().init()
+            LogInfo("progress: %@ %.1f%%", package.name(), percent)
+            self.lastDownloadPercent[sha1] = percent
+            self.lastDownloadTimestamp[sha1] = NSDate.alloc().init()
+    
+    def downloadRetrying_attempt_error_(self, package, attempt, message):
+        LogNotice("Retrying %@ (attempt %d): %@", package.name(), attempt, message)
+        self.downloadRetries += 1
     
     def downloadSucceeded_(self, package):
         LogDebug("downloadSucceeded:")
     
     def downloadFailed_withError_(self, package, message):
-        self.failWithMessage_("Download of %s failed: %s" % (package.name(), message))
+        # Other downloads keep going, so stay busy until downloadAllDone.
+        LogError("Download of %@ failed: %@", package.name(), message)
+        self.failureMessages.append("Download of %s failed: %s" % (package.name(), message))
+        self.hasFailed = True
     
     
     
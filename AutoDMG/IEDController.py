@@ -340,6 +340,7 @@ class IEDController(NSObject):
         
         self.workflow.setPackagesToInstall_(self.updateController.packagesToInstall() +
                                             self.addPkgController.packagesToInstall())
+        self.updateController.cache.markPackagesUsed_(self.updateController.packagesToInstall())
         self.workflow.setOutputPath_(panel.URL().path())
         self.workflow.start()
     
@@ -347,7 +348,8 @@ class IEDController(NSObject):
     
     def buildStartingWithOutput_(self, outputPath):
         self.buildProgressWindow.setTitle_(os.path.basename(outputPath))
-        self.buildProgressPhase.setStringValue_("Starting")
+        self.buildPhase = "Starting"
+        self.buildProgressPhase.setStringValue_(self.buildPhase)
         self.buildProgressBar.setIndeterminate_(True)
         self.buildProgressBar.startAnimation_(self)
         self.buildProgressBar.setDoubleValue_(0.0)
@@ -359,12 +361,21 @@ class IEDController(NSObject):
         self.buildProgressBar.setMaxValue_(totalWeight)
     
     def buildSetPhase_(self, phase):
+        self.buildPhase = phase
         self.buildProgressPhase.setStringValue_(phase)
     
     def buildSetProgress_(self, progress):
         self.buildProgressBar.setDoubleValue_(progress)
         self.buildProgressBar.setIndeterminate_(False)
     
+    def buildSetRemainingSeconds_throughput_(self, seconds, bytesPerSecond):
+        if seconds is None:
+            return
+        status = "%s (about %s remaining" % (self.buildPhase, IEDUtil.formatDuration_(seconds))
+        if bytesPerSecond:
+            status += ", %s/s" % IEDUtil.formatByteSize_(bytesPerSecond)
+        self.buildProgressPhase.setStringValue_(status + ")")
+    
     def buildSetProgressMessage_(self, message):
         self.buildProgressMessage.setStringValue_(message)
     
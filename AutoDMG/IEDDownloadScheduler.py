@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDDownloadScheduler.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import re
+import time
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+from IEDUtil import *
+
+
+class IEDDownloadScheduler(NSObject):
+    """Limit the bandwidth used by update downloads, and the times of day
+    when they are allowed to run.
+    
+    The rate limit is a token bucket shared by all downloads, set in bytes
+    per second by UpdateDownloadRateLimit (0 for unlimited). Download
+    windows are set by UpdateDownloadWindows, a list of local times like
+    "22:00-06:00". Downloads are allowed at any time if it's empty."""
+    
+    re_window = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$')
+    
+    def initWithRateLimit_(self, rateLimit):
+        self = super(IEDDownloadScheduler, self).init()
+        if self is None:
+            return None
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        if rateLimit is None:
+            rateLimit = defaults.integerForKey_("UpdateDownloadRateLimit")
+        self.rate = float(max(0, rateLimit))
+        self.tokens = self.rate
+        self.lastRefill = time.time()
+        if self.rate:
+            LogInfo("Limiting downloads to %@/s", IEDUtil.formatByteSize_(self.rate))
+        
+        self.windows = self.parseWindows_(defaults.stringArrayForKey_("UpdateDownloadWindows") or list())
+        
+        return self
+    
+    # Rate limit.
+    
+    def delayForBytes_(self, size):
+        """Take size bytes from the bucket, and return how many seconds the
+        caller should wait before reading more."""
+        
+        if not self.rate:
+            return 0.0
+        now = time.time()
+        # Allow bursts of up to one second's worth of data.
+        self.tokens = min(self.rate, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+        self.tokens -= size
+        if self.tokens >= 0.0:
+            return 0.0
+        return -self.tokens / self.rate
+    
+    # Download windows.
+    
+    def parseWindows_(self, windows):
+        """Return a list of (start, end) tuples, in minutes after midnight,
+        for the valid windows."""
+        
+        parsed = list()
+        for window in windows:
+            m = self.re_window.match(window)
+            if not m:
+                LogWarning("Ignoring invalid download window '%@'", window)
+                continue
+            startHour, startMinute, endHour, endMinute = (int(x) for x in m.groups())
+            if max(startHour, endHour) > 23 or max(startMinute, endMinute) > 59:
+                LogWarning("Ignoring invalid download window '%@'", window)
+                continue
+            parsed.append((startHour * 60 + startMinute, endHour * 60 + endMinute))
+        return parsed
+    
+    def hasWindows(self):
+        return bool(self.windows)
+    
+    def isInWindowAtMinute_(self, minute):
+        if not self.windows:
+            return True
+        for start, end in self.windows:
+            if start == end:
+                return True
+            if start < end and start <= minute < end:
+                return True
+            if start > end and (minute >= start or minute < end):
+                return True
+        return False
+    
+    def currentMinute(self):
+        now = time.localtime()
+        return now.tm_hour * 60 + now.tm_min, now.tm_sec
+    
+    def isInWindow(self):
+        return self.isInWindowAtMinute_(self.currentMinute()[0])
+    
+    def secondsUntilWindowChange(self):
+        """Return the number of seconds until downloads are allowed if
+        they're not, or until they're no longer allowed if they are. Returns
+        None if that never happens."""
+        
+        minute, second = self.currentMinute()
+        return self.secondsUntilWindowChangeAtMinute_second_(minute, second)
+    
+    def secondsUntilWindowChangeAtMinute_second_(self, minute, second):
+        inWindow = self.isInWindowAtMinute_(minute)
+        for offset in range(1, 24 * 60 + 1):
+            if self.isInWindowAtMinute_((minute + offset) % (24 * 60)) != inWindow:
+                return offset * 60 - second
+        return None
@@ -13,9 +13,12 @@ from CocoaWrapper import *
 from objc import IBOutlet
 
 import os.path
+import re
+import hashlib
 from collections import defaultdict
 from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
 from IEDUtil import *
+from IEDBuildTelemetry import *
 
 
 class IEDProfileController(NSObject):
@@ -26,6 +29,9 @@ class IEDProfileController(NSObject):
     progressBar = IBOutlet()
     delegate = IBOutlet()
     
+    # Bump when the indexed structures change.
+    SNAPSHOT_VERSION = 3
+    
     def awakeFromNib(self):
         # Save the path to UpdateProfiles.plist in the user's application
         # support directory.
@@ -36,14 +42,38 @@ class IEDProfileController(NSObject):
                                                                                  True,
                                                                                  None)
         self.userUpdateProfilesPath = os.path.join(url.path(), "AutoDMG", "UpdateProfiles.plist")
+        # The ETag and Last-Modified headers of the last profile download
+        # are saved next to it, for conditional requests.
+        self.userUpdateValidatorsPath = os.path.join(url.path(), "AutoDMG", "UpdateProfilesValidators.plist")
+        # Parsed and indexed profiles are cached in a snapshot, which is
+        # used as long as neither plist has changed.
+        self.snapshotPath = os.path.join(url.path(), "AutoDMG", "UpdateProfilesSnapshot.plist")
+        self.bundleUpdateProfilesPath = NSBundle.mainBundle().pathForResource_ofType_("UpdateProfiles", "plist")
+        # Durations of earlier builds, for the build time of each profile.
+        self.telemetry = IEDBuildTelemetry.alloc().init()
+        
+        if self.loadSnapshot():
+            if self.delegate:
+                self.delegate.profilesUpdated()
+            return
         
         # Load UpdateProfiles from the application bundle.
-        bundleUpdateProfilesPath = NSBundle.mainBundle().pathForResource_ofType_("UpdateProfiles", "plist")
-        bundleUpdateProfiles = NSDictionary.dictionaryWithContentsOfFile_(bundleUpdateProfilesPath)
+        bundleUpdateProfiles = NSDictionary.dictionaryWithContentsOfFile_(self.bundleUpdateProfilesPath)
         
-        latestProfiles = self.updateUsersProfilesIfNewer_(bundleUpdateProfiles)
-        # Load the profiles.
-        self.loadProfilesFromPlist_(latestProfiles)
+        if self.validateProfilesPlist_(bundleUpdateProfiles):
+            LogError("The update profiles in the application bundle are invalid")
+            latestProfiles = NSDictionary.dictionaryWithContentsOfFile_(self.userUpdateProfilesPath)
+        else:
+            latestProfiles = self.updateUsersProfilesIfNewer_(bundleUpdateProfiles)
+        # Load the profiles, falling back to the bundled ones, and to no
+        # profiles at all if neither can be used.
+        if self.loadProfilesFromPlist_(latestProfiles):
+            self.saveSnapshot()
+        elif latestProfiles is not bundleUpdateProfiles and self.loadProfilesFromPlist_(bundleUpdateProfiles):
+            LogWarning("Using the update profiles in the application bundle")
+        else:
+            LogError("No usable update profiles")
+            self.resetProfiles()
     
     def setDelegate_(self, delegate):
         self.delegate = delegate
@@ -77,37 +107,25 @@ class IEDProfileController(NSObject):
         whyMajor = whyVersionTuple[1]
         whyPoint = whyVersionTuple[2] if len(whyVersionTuple) > 2 else None
         
-        buildsForVersion = defaultdict(set)
-        supportedMajorVersions = set()
-        supportedPointReleases = defaultdict(set)
-        for versionBuild in self.profiles.iterkeys():
-            version, _, build = versionBuild.partition("-")
-            buildsForVersion[version].add(build)
-            versionTuple = IEDUtil.splitVersion(version)
-            major = versionTuple[1]
-            supportedMajorVersions.add(major)
-            point = versionTuple[2] if len(versionTuple) > 2 else 0
-            supportedPointReleases[major].add(point)
-        
         LogDebug("supported OS X versions: %@",
-                 ", ".join("10.%d" % x for x in sorted(supportedMajorVersions)))
+                 ", ".join("10.%d" % x for x in self.supportedMajorVersions))
         LogDebug("supported point releases:")
-        for major, pointReleases in supportedPointReleases.iteritems():
-            LogDebug("    " + ", ".join("10.%d.%d" % (major, x) for x in sorted(pointReleases)))
+        for major in self.supportedMajorVersions:
+            LogDebug("    " + ", ".join("10.%d.%d" % (major, x) for x in self.supportedPointReleases[major]))
         
-        if whyMajor not in supportedMajorVersions:
+        if whyMajor not in self.supportedPointReleases:
             LogDebug("10.%d is not supported", whyMajor)
             return "10.%d is not supported" % whyMajor
-        elif whyVersion in buildsForVersion:
+        elif whyVersion in self.buildsForVersion:
             LogDebug("Unknown build %@", whyBuild)
             return "Unknown build %s" % whyBuild
         else:
             # It's a supported OS X version, but we don't have a profile for
             # this point release. Try to figure out if that's because it's too
             # old or too new.
-            pointReleases = supportedPointReleases[whyMajor]
-            oldestSupportedPointRelease = sorted(pointReleases)[0]
-            newestSupportedPointRelease = sorted(pointReleases)[-1]
+            pointReleases = self.supportedPointReleases[whyMajor]
+            oldestSupportedPointRelease = pointReleases[0]
+            newestSupportedPointRelease = pointReleases[-1]
             if whyPoint < oldestSupportedPointRelease:
                 LogDebug("Deprecated installer")
                 return "Deprecated installer"
@@ -121,6 +139,79 @@ class IEDProfileController(NSObject):
                 LogDebug("Unknown %@ installer", whyVersion)
                 return "Unknown %s installer" % whyVersion
     
+    def indexProfiles(self):
+        """Index the loaded profiles by version, so that lookups don't have
+        to parse every profile name."""
+        
+        buildsForVersion = defaultdict(set)
+        pointReleases = defaultdict(set)
+        for versionBuild in self.profiles.iterkeys():
+            version, _, build = unicode(versionBuild).partition("-")
+            buildsForVersion[version].add(build)
+            versionTuple = IEDUtil.splitVersion(version)
+            pointReleases[versionTuple[1]].add(versionTuple[2] if len(versionTuple) > 2 else 0)
+        
+        self.buildsForVersion = dict((version, frozenset(builds))
+                                     for version, builds in buildsForVersion.iteritems())
+        # Point releases are sorted, so the oldest and newest are at the ends.
+        self.supportedPointReleases = dict((major, tuple(sorted(points)))
+                                           for major, points in pointReleases.iteritems())
+        self.supportedMajorVersions = tuple(sorted(self.supportedPointReleases))
+        self.profileSizes = dict((name, sum(update["size"] for update in profile))
+                                 for name, profile in self.profiles.iteritems())
+        self.estimateBuildTimes()
+    
+    def estimateBuildTimes(self):
+        # Not part of the snapshot, as it changes with every build.
+        self.profileEstimates = dict()
+        for name, profile in self.profiles.iteritems():
+            sizes = list(update["size"] for update in profile)
+            self.profileEstimates[name] = self.telemetry.estimateSecondsForUpdateSizes_(sizes)
+    
+    def summaryForVersion_build_cache_(self, version, build, cache):
+        """Summarize what building with the profile for a version and build
+        takes: the number of updates, their total size, how much of that is
+        cached and how much needs to be downloaded, the sha1s of the missing
+        updates, and an estimated build time in seconds (or None). Returns
+        None if there is no profile."""
+        
+        name = "%s-%s" % (version, build)
+        if name not in self.profiles:
+            return None
+        missing = list(update["sha1"] for update in self.profiles[name] if not cache.isCached_(update["sha1"]))
+        missingSet = set(missing)
+        downloadBytes = sum(update["size"] for update in self.profiles[name] if update["sha1"] in missingSet)
+        totalBytes = self.profileSizes[name]
+        return {
+            "updateCount": len(self.profiles[name]),
+            "totalBytes": totalBytes,
+            "cachedBytes": totalBytes - downloadBytes,
+            "downloadBytes": downloadBytes,
+            "missingSha1s": missing,
+            "estimatedBuildSeconds": self.profileEstimates[name],
+        }
+    
+    def summaryDescription_(self, summary):
+        """Describe a summary as "X to fetch, ~Y build"."""
+        
+        if summary["downloadBytes"]:
+            text = "%s to fetch" % IEDUtil.formatByteSize_(summary["downloadBytes"])
+        else:
+            text = "all cached"
+        if summary["estimatedBuildSeconds"] is not None:
+            text += ", ~%s build" % IEDUtil.formatDuration_(summary["estimatedBuildSeconds"])
+        return text
+    
+    def profileNamesForVersion_(self, version):
+        """Return the names of the profiles for a version, or for all point
+        releases of a major version like 10.13."""
+        
+        names = list()
+        for profileVersion, builds in self.buildsForVersion.iteritems():
+            if profileVersion == version or profileVersion.startswith(version + "."):
+                names.extend("%s-%s" % (profileVersion, build) for build in builds)
+        return sorted(names)
+    
     def updateUsersProfilesIfNewer_(self, plist):
         """Update the user's update profiles if plist is newer. Returns
            whichever was the newest."""
@@ -129,6 +220,9 @@ class IEDProfileController(NSObject):
         
         # Load UpdateProfiles from the user's application support directory.
         userUpdateProfiles = NSDictionary.dictionaryWithContentsOfFile_(self.userUpdateProfilesPath)
+        if userUpdateProfiles and self.validateProfilesPlist_(userUpdateProfiles):
+            LogWarning("Replacing invalid %@", self.userUpdateProfilesPath)
+            userUpdateProfiles = None
         
         # Ensure profile in plist supports current OS.
         plistVersions = list(x.partition("-")[0] for x in plist["Profiles"].iterkeys())
@@ -161,57 +255,245 @@ class IEDProfileController(NSObject):
         if not plist.writeToFile_atomically_(self.userUpdateProfilesPath, False):
             LogError("Failed to write %@", self.userUpdateProfilesPath)
     
+    re_sha1 = re.compile(r'^[0-9a-fA-F]{40}$')
+    re_version = re.compile(r'^\d+(\.\d+)+$')
+    
+    def validateProfilesPlist_(self, plist):
+        """Check the structure of an UpdateProfiles plist in one pass, and
+        return a list of all errors found."""
+        
+        if not isinstance(plist, NSDictionary):
+            return ["UpdateProfiles is missing or not a dictionary"]
+        
+        errors = list()
+        if not isinstance(plist.get("PublicationDate"), NSDate):
+            errors.append("PublicationDate is missing or not a date")
+        updates = plist.get("Updates")
+        if not isinstance(updates, NSDictionary):
+            errors.append("Updates is missing or not a dictionary")
+            updates = dict()
+        profiles = plist.get("Profiles")
+        if not isinstance(profiles, NSDictionary):
+            errors.append("Profiles is missing or not a dictionary")
+            profiles = dict()
+        
+        for key, update in updates.iteritems():
+            if not isinstance(update, NSDictionary):
+                errors.append("Update %s is not a dictionary" % key)
+                continue
+            for field in ("name", "url"):
+                if not isinstance(update.get(field), basestring) or not update.get(field):
+                    errors.append("Update %s has no %s" % (key, field))
+            url = update.get("url")
+            if isinstance(url, basestring) and url and not url.startswith(("http://", "https://")):
+                errors.append("Update %s has invalid url %s" % (key, url))
+            sha1 = update.get("sha1")
+            if not isinstance(sha1, basestring) or not self.re_sha1.match(sha1):
+                errors.append("Update %s has invalid sha1 %s" % (key, sha1))
+            size = update.get("size")
+            if isinstance(size, bool) or not isinstance(size, (int, long)) or size <= 0:
+                errors.append("Update %s has invalid size %s" % (key, size))
+        
+        for name, keys in profiles.iteritems():
+            version, _, build = name.partition("-")
+            if not self.re_version.match(version) or not build:
+                errors.append("Profile %s isn't named version-build" % name)
+            if not isinstance(keys, NSArray):
+                errors.append("Profile %s is not a list" % name)
+                continue
+            for key in keys:
+                if key not in updates:
+                    errors.append("Profile %s references unknown update %s" % (name, key))
+        
+        deprecatedInstallers = plist.get("DeprecatedInstallers", dict())
+        if not isinstance(deprecatedInstallers, (dict, NSDictionary)) or \
+           not all(isinstance(builds, NSArray) for builds in deprecatedInstallers.itervalues()):
+            errors.append("DeprecatedInstallers is not a dictionary of lists")
+        for osVerStr in plist.get("DeprecatedOSVersions", list()):
+            if not isinstance(osVerStr, basestring) or not self.re_version.match(osVerStr):
+                errors.append("DeprecatedOSVersions has invalid version %s" % osVerStr)
+        
+        return errors
+    
+    def resetProfiles(self):
+        """Start out with no profiles, when none can be loaded."""
+        
+        self.profiles = dict()
+        self.updatePaths = dict()
+        self.publicationDate = NSDate.dateWithTimeIntervalSince1970_(0.0)
+        self.deprecatedInstallerBuilds = dict()
+        self.deprecatedOS = False
+        self.indexProfiles()
+    
     def loadProfilesFromPlist_(self, plist):
-        """Load UpdateProfiles from a plist dictionary."""
+        """Load UpdateProfiles from a plist dictionary. Returns False, and
+        keeps the current profiles, if the plist doesn't validate."""
+        
+        errors = self.validateProfilesPlist_(plist)
+        if errors:
+            for error in errors:
+                LogError("%@", error)
+            LogError("Failed to load profile: %d error%@", len(errors), "" if len(errors) == 1 else "s")
+            return False
         
         LogInfo("Loading update profiles with PublicationDate %@", plist["PublicationDate"])
         
-        try:
-            # FIXME: Add profile verification.
-            
-            self.profiles = dict()
-            for name, updates in plist["Profiles"].iteritems():
-                profile = list()
-                for update in updates:
-                    profile.append(plist["Updates"][update])
-                self.profiles[name] = profile
-        
-            self.publicationDate = plist["PublicationDate"]
-        
-            self.updatePaths = dict()
-            for name, update in plist["Updates"].iteritems():
-                filename, ext = os.path.splitext(os.path.basename(update["url"]))
-                self.updatePaths[update["sha1"]] = "%s(%s)%s" % (filename, update["sha1"][:7], ext)
-        
-            self.deprecatedInstallerBuilds = dict()
-            try:
-                for replacement, builds in plist["DeprecatedInstallers"].iteritems():
-                    for build in builds:
-                        self.deprecatedInstallerBuilds[build] = replacement
-            except KeyError:
-                LogWarning("No deprecated installers in profile")
+        updates = dict()
+        self.updatePaths = dict()
+        for key, update in plist["Updates"].iteritems():
+            updates[key] = {
+                "name": unicode(update["name"]),
+                "url": unicode(update["url"]),
+                "sha1": unicode(update["sha1"]),
+                "size": int(update["size"]),
+            }
+            filename, ext = os.path.splitext(os.path.basename(update["url"]))
+            self.updatePaths[update["sha1"]] = "%s(%s)%s" % (filename, update["sha1"][:7], ext)
         
-            self.deprecatedOS = False
-            try:
-                for osVerStr in plist["DeprecatedOSVersions"]:
-                    deprecatedVerMajor = IEDUtil.splitVersion(osVerStr)[1]
-                    if IEDUtil.hostMajorVersion() <= deprecatedVerMajor:
-                        self.deprecatedOS = True
-                        LogWarning("%@ is no longer being updated by Apple", osVerStr)
-                        break
-            except KeyError:
-                LogWarning("No deprecated OS versions in profile")
+        self.profiles = dict()
+        for name, keys in plist["Profiles"].iteritems():
+            self.profiles[unicode(name)] = list(updates[key] for key in keys)
+        self.indexProfiles()
         
-            if self.delegate:
-                self.delegate.profilesUpdated()
-        except BaseException as e:
-            LogError("Failed to load profile: %@", unicode(e))
+        self.publicationDate = plist["PublicationDate"]
+        
+        self.deprecatedInstallerBuilds = dict()
+        if "DeprecatedInstallers" not in plist:
+            LogWarning("No deprecated installers in profile")
+        for replacement, builds in plist.get("DeprecatedInstallers", dict()).iteritems():
+            for build in builds:
+                self.deprecatedInstallerBuilds[build] = replacement
+        
+        self.deprecatedOS = False
+        if "DeprecatedOSVersions" not in plist:
+            LogWarning("No deprecated OS versions in profile")
+        for osVerStr in plist.get("DeprecatedOSVersions", list()):
+            deprecatedVerMajor = IEDUtil.splitVersion(osVerStr)[1]
+            if IEDUtil.hostMajorVersion() <= deprecatedVerMajor:
+                self.deprecatedOS = True
+                LogWarning("%@ is no longer being updated by Apple", osVerStr)
+                break
+        
+        if self.delegate:
+            self.delegate.profilesUpdated()
+        return True
+    
+    
+    # Profile snapshot.
+    
+    def snapshotKey(self):
+        """Identify the source plists by mtime and sha1. The host version is
+        included as it decides deprecatedOS."""
+        
+        sources = list()
+        for path in (self.bundleUpdateProfilesPath, self.userUpdateProfilesPath):
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                sources.append((path, os.path.getmtime(path), hashlib.sha1(data).hexdigest()))
+            except (IOError, OSError):
+                sources.append((path, None, None))
+        # A string, as plists can't hold None.
+        return unicode(repr((IEDUtil.hostMajorVersion(), tuple(sources))))
+    
+    def plainValue_(self, value):
+        # Convert plist objects to plain Python objects.
+        if isinstance(value, (dict, NSDictionary)):
+            return dict((unicode(k), self.plainValue_(v)) for k, v in value.iteritems())
+        if isinstance(value, (list, tuple, NSArray)):
+            return list(self.plainValue_(v) for v in value)
+        if isinstance(value, basestring):
+            return unicode(value)
+        if isinstance(value, bool):
+            return bool(value)
+        if isinstance(value, (int, long)):
+            return int(value)
+        if isinstance(value, float):
+            return float(value)
+        return value
+    
+    def loadSnapshot(self):
+        # The snapshot is a plist rather than a pickle, as loading a pickle
+        # that another account can write runs arbitrary code when the CLI
+        # runs with sudo.
+        data = NSData.dataWithContentsOfFile_(self.snapshotPath)
+        if data is None:
+            return False
+        plist, format, error = NSPropertyListSerialization.propertyListWithData_options_format_error_(data,
+                                                                                                      NSPropertyListImmutable,
+                                                                                                      None,
+                                                                                                      None)
+        if not isinstance(plist, NSDictionary):
+            LogWarning("Ignoring unreadable profile snapshot: %@", error.localizedDescription() if error else "not a dictionary")
+            return False
+        snapshot = self.plainValue_(plist)
+        if snapshot.get("version") != self.SNAPSHOT_VERSION or snapshot.get("key") != self.snapshotKey():
+            LogDebug("Profile snapshot is out of date")
+            return False
+        try:
+            profiles = snapshot["profiles"]
+            publicationDate = NSDate.dateWithTimeIntervalSince1970_(snapshot["publicationDate"])
+            updatePaths = snapshot["updatePaths"]
+            deprecatedInstallerBuilds = snapshot["deprecatedInstallerBuilds"]
+            deprecatedOS = bool(snapshot["deprecatedOS"])
+            # Restore the types that plists don't have.
+            buildsForVersion = dict((version, frozenset(builds))
+                                    for version, builds in snapshot["buildsForVersion"].iteritems())
+            supportedPointReleases = dict((int(major), tuple(points))
+                                          for major, points in snapshot["supportedPointReleases"].iteritems())
+            supportedMajorVersions = tuple(snapshot["supportedMajorVersions"])
+            profileSizes = snapshot["profileSizes"]
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            LogWarning("Ignoring malformed profile snapshot: %@", unicode(e))
+            return False
+        self.profiles = profiles
+        self.publicationDate = publicationDate
+        self.updatePaths = updatePaths
+        self.deprecatedInstallerBuilds = deprecatedInstallerBuilds
+        self.deprecatedOS = deprecatedOS
+        self.buildsForVersion = buildsForVersion
+        self.supportedPointReleases = supportedPointReleases
+        self.supportedMajorVersions = supportedMajorVersions
+        self.profileSizes = profileSizes
+        self.estimateBuildTimes()
+        LogInfo("Loaded update profiles with PublicationDate %@ from snapshot", self.publicationDate)
+        return True
+    
+    def saveSnapshot(self):
+        snapshot = {
+            "version": self.SNAPSHOT_VERSION,
+            "key": self.snapshotKey(),
+            "profiles": self.plainValue_(self.profiles),
+            "publicationDate": self.publicationDate.timeIntervalSince1970(),
+            "updatePaths": self.plainValue_(self.updatePaths),
+            "deprecatedInstallerBuilds": self.plainValue_(self.deprecatedInstallerBuilds),
+            "deprecatedOS": self.deprecatedOS,
+            "buildsForVersion": dict((version, sorted(builds))
+                                     for version, builds in self.buildsForVersion.iteritems()),
+            "supportedPointReleases": dict((unicode(major), list(points))
+                                           for major, points in self.supportedPointReleases.iteritems()),
+            "supportedMajorVersions": list(self.supportedMajorVersions),
+            "profileSizes": self.profileSizes,
+        }
+        data, error = NSPropertyListSerialization.dataWithPropertyList_format_options_error_(snapshot,
+                                                                                             NSPropertyListBinaryFormat_v1_0,
+                                                                                             0,
+                                                                                             None)
+        if data is None:
+            LogWarning("Failed to serialize profile snapshot: %@", error.localizedDescription() if error else "")
+            return
+        if not data.writeToFile_atomically_(self.snapshotPath, True):
+            LogWarning("Failed to save profile snapshot to %@", self.snapshotPath)
     
     
     # Update profiles.
     
     def updateFromURL_(self, url):
-        """Download the latest UpdateProfiles.plist."""
+        """Download the latest UpdateProfiles.plist.
+        
+        If UpdateProfilesDeltaURL is set, a delta with the changes since the
+        user's profiles is tried first, and the full plist is only
+        downloaded if the delta can't be applied."""
         
         LogDebug("updateFromURL:%@", url)
         
@@ -221,10 +503,42 @@ class IEDProfileController(NSObject):
             self.progressBar.startAnimation_(self)
             self.profileUpdateWindow.makeKeyAndOrderFront_(self)
         
+        self.profileUpdateURL = url
+        deltaURL = NSUserDefaults.standardUserDefaults().stringForKey_("UpdateProfilesDeltaURL")
+        if deltaURL and os.path.exists(self.userUpdateProfilesPath):
+            self.startDeltaDownload_(NSURL.URLWithString_(deltaURL))
+        else:
+            self.startFullDownload()
+    
+    def startDeltaDownload_(self, url):
+        LogDebug("Downloading profile delta from %@", url)
+        self.profileUpdateData = NSMutableData.alloc().init()
+        self.fetchingDelta = True
+        request = NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(url,
+                                                                                  NSURLRequestReloadIgnoringLocalCacheData,
+                                                                                  60.0)
+        self.connection = NSURLConnection.connectionWithRequest_delegate_(request, self)
+        if not self.connection:
+            LogWarning("Connection to %@ failed", url)
+            self.startFullDownload()
+    
+    def startFullDownload(self):
+        url = self.profileUpdateURL
         # Create a buffer for data.
         self.profileUpdateData = NSMutableData.alloc().init()
-        # Start download.
-        request = NSURLRequest.requestWithURL_(url)
+        self.fetchingDelta = False
+        self.profileUpdateValidators = None
+        # Start download, asking the server to skip it if the profiles
+        # haven't changed since last time.
+        request = NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(url,
+                                                                                  NSURLRequestReloadIgnoringLocalCacheData,
+                                                                                  60.0)
+        validators = self.savedValidatorsForURL_(url)
+        if validators:
+            if "ETag" in validators:
+                request.setValue_forHTTPHeaderField_(validators["ETag"], "If-None-Match")
+            if "Last-Modified" in validators:
+                request.setValue_forHTTPHeaderField_(validators["Last-Modified"], "If-Modified-Since")
         self.connection = NSURLConnection.connectionWithRequest_delegate_(request, self)
         LogDebug("connection = %@", self.connection)
         if not self.connection:
@@ -234,14 +548,61 @@ class IEDProfileController(NSObject):
             self.delegate.profileUpdateFailed_(error)
     
     def connection_didFailWithError_(self, connection, error):
+        if self.fetchingDelta:
+            LogWarning("Profile delta download failed, downloading full profiles: %@", error)
+            self.startFullDownload()
+            return
         LogError("Profile update failed: %@", error)
         if self.profileUpdateWindow:
             self.profileUpdateWindow.orderOut_(self)
         self.delegate.profileUpdateFailed_(error)
         self.delegate.profileUpdateAllDone()
     
+    def savedValidatorsForURL_(self, url):
+        if not os.path.exists(self.userUpdateProfilesPath):
+            return None
+        validators = NSDictionary.dictionaryWithContentsOfFile_(self.userUpdateValidatorsPath)
+        if not validators or validators.get("URL") != unicode(url):
+            return None
+        return validators
+    
+    def saveValidators_(self, validators):
+        if not validators:
+            try:
+                os.unlink(self.userUpdateValidatorsPath)
+            except OSError:
+                pass
+            return
+        if not NSDictionary.dictionaryWithDictionary_(validators).writeToFile_atomically_(self.userUpdateValidatorsPath,
+                                                                                            True):
+            LogWarning("Failed to write %@", self.userUpdateValidatorsPath)
+    
     def connection_didReceiveResponse_(self, connection, response):
         LogDebug("%@ status code %d", connection, response.statusCode())
+        if self.fetchingDelta:
+            if response.statusCode() != 200:
+                LogWarning("Profile delta download failed with HTTP %d, downloading full profiles",
+                           response.statusCode())
+                connection.cancel()
+                self.startFullDownload()
+            return
+        if response.statusCode() == 304:
+            LogNotice("Update profiles haven't changed since last download")
+            connection.cancel()
+            if self.profileUpdateWindow:
+                self.profileUpdateWindow.orderOut_(self)
+            self.delegate.profileUpdateSucceeded_(self.publicationDate)
+            self.delegate.profileUpdateAllDone()
+            return
+        validators = dict()
+        for key, value in response.allHeaderFields().iteritems():
+            if key.lower() == "etag":
+                validators["ETag"] = value
+            elif key.lower() == "last-modified":
+                validators["Last-Modified"] = value
+        if validators:
+            validators["URL"] = unicode(self.profileUpdateURL)
+        self.profileUpdateValidators = validators
         if response.expectedContentLength() == NSURLResponseUnknownLength:
             LogDebug("unknown response length")
         else:
@@ -258,6 +619,9 @@ class IEDProfileController(NSObject):
     
     def connectionDidFinishLoading_(self, connection):
         LogDebug("Downloaded profile with %d bytes", self.profileUpdateData.length())
+        if self.fetchingDelta:
+            self.deltaDidFinishLoading()
+            return
         if self.profileUpdateWindow:
             # Hide the progress window.
             self.profileUpdateWindow.orderOut_(self)
@@ -269,15 +633,109 @@ class IEDProfileController(NSObject):
         if not plist:
             self.delegate.profileUpdateFailed_(error)
             return
+        errors = self.validateProfilesPlist_(plist)
+        if errors:
+            # Don't replace the user's profiles with a broken plist.
+            for message in errors:
+                LogError("%@", message)
+            self.delegate.profileUpdateFailed_(self.invalidProfileError_(len(errors)))
+            self.delegate.profileUpdateAllDone()
+            return
         LogNotice("Downloaded update profiles with PublicationDate %@", plist["PublicationDate"])
         # Update the user's profiles if it's newer.
         latestProfiles = self.updateUsersProfilesIfNewer_(plist)
+        self.saveValidators_(self.profileUpdateValidators)
         # Load the latest profiles.
         self.loadProfilesFromPlist_(latestProfiles)
+        self.saveSnapshot()
         # Notify delegate.
         self.delegate.profileUpdateSucceeded_(latestProfiles["PublicationDate"])
         self.delegate.profileUpdateAllDone()
     
+    def deltaDidFinishLoading(self):
+        delta, format, error = NSPropertyListSerialization.propertyListWithData_options_format_error_(self.profileUpdateData,
+                                                                                                       NSPropertyListImmutable,
+                                                                                                       None,
+                                                                                                       None)
+        if not delta or "PublicationDate" not in delta:
+            LogWarning("Couldn't decode profile delta, downloading full profiles")
+            self.startFullDownload()
+            return
+        if delta["PublicationDate"] == self.publicationDate:
+            LogNotice("Update profiles are up to date")
+            plist = None
+        else:
+            plist = self.applyDelta_(delta)
+            if plist is None:
+                self.startFullDownload()
+                return
+        if self.profileUpdateWindow:
+            self.profileUpdateWindow.orderOut_(self)
+        if plist is not None:
+            LogNotice("Updated profiles to PublicationDate %@ from delta", plist["PublicationDate"])
+            self.saveUsersProfiles_(plist)
+            # The saved validators belong to an older full plist.
+            self.saveValidators_(None)
+            self.loadProfilesFromPlist_(plist)
+            self.saveSnapshot()
+        self.delegate.profileUpdateSucceeded_(self.publicationDate)
+        self.delegate.profileUpdateAllDone()
+    
+    def applyDelta_(self, delta):
+        """Apply a profile delta to the user's UpdateProfiles.plist and return
+        the result, or None if the delta doesn't apply.
+        
+        The delta is a dictionary with BasePublicationDate, which has to
+        match the user's profiles, the new PublicationDate, AddedUpdates and
+        AddedProfiles dictionaries, RemovedUpdates and RemovedProfiles lists
+        of keys, and optionally new DeprecatedInstallers and
+        DeprecatedOSVersions."""
+        
+        current = NSDictionary.dictionaryWithContentsOfFile_(self.userUpdateProfilesPath)
+        if not current:
+            return None
+        try:
+            if delta["BasePublicationDate"] != current["PublicationDate"]:
+                LogInfo("Profile delta is based on %@, but profiles are from %@",
+                        delta["BasePublicationDate"], current["PublicationDate"])
+                return None
+            updates = NSMutableDictionary.dictionaryWithDictionary_(current["Updates"])
+            for key in delta.get("RemovedUpdates", list()):
+                updates.removeObjectForKey_(key)
+            updates.addEntriesFromDictionary_(delta.get("AddedUpdates", dict()))
+            profiles = NSMutableDictionary.dictionaryWithDictionary_(current["Profiles"])
+            for name in delta.get("RemovedProfiles", list()):
+                profiles.removeObjectForKey_(name)
+            profiles.addEntriesFromDictionary_(delta.get("AddedProfiles", dict()))
+            for name, keys in profiles.iteritems():
+                for key in keys:
+                    if key not in updates:
+                        LogWarning("Profile delta leaves %@ referencing unknown update %@", name, key)
+                        return None
+            plist = NSMutableDictionary.dictionaryWithDictionary_(current)
+            plist["Updates"] = updates
+            plist["Profiles"] = profiles
+            plist["PublicationDate"] = delta["PublicationDate"]
+            for key in ("DeprecatedInstallers", "DeprecatedOSVersions"):
+                if key in delta:
+                    plist[key] = delta[key]
+        except (KeyError, TypeError, ValueError) as e:
+            LogWarning("Invalid profile delta: %@", unicode(e))
+            return None
+        errors = self.validateProfilesPlist_(plist)
+        if errors:
+            for message in errors:
+                LogWarning("Profile delta result: %@", message)
+            return None
+        return plist
+    
+    def invalidProfileError_(self, count):
+        userInfo = {
+            NSLocalizedDescriptionKey: "Downloaded update profiles have %d error%s" % (count, "" if count == 1 else "s"),
+            NSErrorFailingURLStringKey: unicode(self.profileUpdateURL),
+        }
+        return NSError.errorWithDomain_code_userInfo_(NSURLErrorDomain, NSURLErrorCannotParseResponse, userInfo)
+    
     def cancelUpdateDownload(self):
         LogInfo("User canceled profile update")
         self.connection.cancel()
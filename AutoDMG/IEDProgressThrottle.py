@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDProgressThrottle.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import time
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+
+
+class IEDProgressThrottle(NSObject):
+    """Decide which progress updates are worth passing on to a delegate.
+    
+    Progress is tracked per key, so parallel downloads are throttled
+    independently. An update is passed on when at least
+    ProgressUpdateInterval seconds have passed and the progress has moved
+    at least ProgressUpdateMinPercent since the last one. The first and the
+    final update for a key are always passed on."""
+    
+    def init(self):
+        self = super(IEDProgressThrottle, self).init()
+        if self is None:
+            return None
+        
+        self.interval = 0.0
+        self.minPercent = 0.0
+        self.lastReported = dict()
+        
+        return self
+    
+    def reset(self):
+        # Defaults are read here rather than in init, as the CLI registers
+        # them after creating its controllers.
+        defaults = NSUserDefaults.standardUserDefaults()
+        self.interval = max(0.0, defaults.doubleForKey_("ProgressUpdateInterval"))
+        self.minPercent = max(0.0, defaults.doubleForKey_("ProgressUpdateMinPercent"))
+        self.lastReported = dict()
+    
+    def shouldReportProgress_ofTotal_forKey_(self, progress, total, key):
+        now = time.time()
+        last = self.lastReported.get(key)
+        if last is None or progress >= total:
+            if last is not None and last[0] == progress:
+                # Don't repeat the final update.
+                return False
+        else:
+            lastProgress, lastTime = last
+            if now - lastTime < self.interval:
+                return False
+            if total and 100.0 * abs(progress - lastProgress) / total < self.minPercent:
+                return False
+        self.lastReported[key] = (progress, now)
+        return True
+    
+    def forgetKey_(self, key):
+        self.lastReported.pop(key, None)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDRetryPolicy.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import random
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+
+
+class IEDRetryPolicy(NSObject):
+    """Decide if and when a failed update download should be retried.
+    
+    The policy is read from the user defaults UpdateDownloadMaxAttempts,
+    UpdateDownloadRetryDelay and UpdateDownloadMaxRetryDelay."""
+    
+    # Server errors and throttling are usually transient, other client
+    # errors aren't going to go away by asking again.
+    RETRYABLE_HTTP_STATUS = (408, 425, 429, 500, 502, 503, 504)
+    
+    # Connection errors that are caused by the request itself.
+    FATAL_URL_ERRORS = (
+        NSURLErrorBadURL,
+        NSURLErrorUnsupportedURL,
+        NSURLErrorCancelled,
+        NSURLErrorUserAuthenticationRequired,
+    )
+    
+    def init(self):
+        self = super(IEDRetryPolicy, self).init()
+        if self is None:
+            return None
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        self.maxAttempts = max(1, defaults.integerForKey_("UpdateDownloadMaxAttempts"))
+        self.baseDelay = max(0.0, defaults.doubleForKey_("UpdateDownloadRetryDelay"))
+        self.maxDelay = max(self.baseDelay, defaults.doubleForKey_("UpdateDownloadMaxRetryDelay"))
+        
+        return self
+    
+    def isRetryableStatus_(self, status):
+        return status in self.RETRYABLE_HTTP_STATUS
+    
+    def isRetryableError_(self, error):
+        if error.domain() != NSURLErrorDomain:
+            return True
+        return error.code() not in self.FATAL_URL_ERRORS
+    
+    def shouldRetryAttempt_(self, attempt):
+        return attempt < self.maxAttempts
+    
+    def delayForAttempt_(self, attempt):
+        """Exponential backoff with jitter, so that hosts that failed at the
+        same time don't all come back at the same time."""
+        
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1))
+        return delay / 2.0 + random.uniform(0.0, delay / 2.0)
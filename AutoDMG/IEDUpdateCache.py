@@ -11,14 +11,24 @@ from __future__ import unicode_literals
 
 from CocoaWrapper import *
 import os
-import hashlib
+import re
+import errno
+import shutil
+import time
 
 from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+from IEDUtil import *
+from IEDUpdateDownload import *
+from IEDRetryPolicy import *
+from IEDProgressThrottle import *
+from IEDDownloadScheduler import *
 
 
 class IEDUpdateCache(NSObject):
     """Managed updates cached on disk in the Application Support directory."""
     
+    re_sha1 = re.compile(r'^[0-9a-fA-F]{40}$')
+    
     def init(self):
         self = super(IEDUpdateCache, self).init()
         if self is None:
@@ -42,6 +52,13 @@ class IEDUpdateCache(NSObject):
                 os.makedirs(self.updateDir)
             except OSError as e:
                 LogError("Failed to create %@: %@", self.updateDir, str(e))
+        self.indexPath = os.path.join(url.path(), "AutoDMG", "UpdateCache.plist")
+        self.quarantineDir = os.path.join(url.path(), "AutoDMG", "Quarantine")
+        self.loadIndex()
+        
+        self.progressThrottle = IEDProgressThrottle.alloc().init()
+        self.rateLimit = None
+        self.windowTimer = None
         
         return self
     
@@ -56,56 +73,320 @@ class IEDUpdateCache(NSObject):
     
     # Given a dictionary with sha1 hashes pointing to filenames, clean the
     # cache of unreferenced items, and create symlinks from the filenames to
-    # the corresponding cache files.
+    # the corresponding cache files. Unreferenced updates are kept up to
+    # UpdateCacheUnreferencedBudget bytes, in case a profile is rolled back
+    # or an older installer is built.
     def pruneAndCreateSymlinks(self, symlinks):
         LogInfo("Pruning cache")
         
         self.symlinks = symlinks
         
-        # Create a reverse dictionary and a set of filenames.
-        names = dict()
+        # One directory listing tells us which links exist, and the index
+        # which cached files are intact.
+        keep = self.filenamesToKeep_(symlinks)
+        items = set(os.listdir(self.updateDir))
+        unreferenced = list()
+        for item in items:
+            if item in keep:
+                continue
+            if self.re_sha1.match(item) and self.isCached_(item):
+                unreferenced.append(item)
+                continue
+            try:
+                LogInfo("Removing %@", item)
+                os.unlink(os.path.join(self.updateDir, item))
+            except OSError as e:
+                LogWarning("Cache pruning of %@ failed: %@", item, str(e))
+        for sha1 in self.unreferencedToEvict_index_(unreferenced, self.index):
+            self.evict_(sha1)
+        for sha1, name in symlinks.iteritems():
+            self.updateLink_name_exists_(sha1, name, name in items)
+        self.prunedLinks = dict(symlinks)
+        self.prunedPublicationDate = None
+        self.indexChanged = True
+        self.saveIndex()
+    
+    # Like pruneAndCreateSymlinks, but only touches the links that changed
+    # since the last prune. Nothing is done at all if the profiles have the
+    # same PublicationDate as last time.
+    def pruneIncrementally_publicationDate_(self, symlinks, publicationDate):
+        if self.prunedLinks is None:
+            self.pruneAndCreateSymlinks(symlinks)
+        else:
+            self.symlinks = symlinks
+            if publicationDate is not None and publicationDate == self.prunedPublicationDate:
+                LogDebug("Profiles unchanged since last prune")
+                return
+            LogInfo("Pruning cache incrementally")
+            for sha1, name in self.prunedLinks.iteritems():
+                if symlinks.get(sha1) != name:
+                    self.removeLink_(name)
+                if sha1 not in symlinks:
+                    self.removeFile_(self.cacheTmpPath_(sha1))
+            for sha1, name in symlinks.iteritems():
+                if self.prunedLinks.get(sha1) != name:
+                    self.updateLink_name_exists_(sha1, name, os.path.lexists(os.path.join(self.updateDir, name)))
+            unreferenced = list(sha1 for sha1 in self.index.iterkeys() if sha1 not in symlinks)
+            for sha1 in self.unreferencedToEvict_index_(unreferenced, self.index):
+                self.evict_(sha1)
+            self.prunedLinks = dict(symlinks)
+        self.prunedPublicationDate = publicationDate
+        self.indexChanged = True
+        self.saveIndex()
+    
+    # Return the number of bytes and the names of the items that
+    # pruneAndCreateSymlinks would remove, without changing anything.
+    def pruneDryRun_(self, symlinks):
+        reclaimed = 0
+        removed = list()
+        unreferenced = list()
+        # isCached_ adopts unindexed files and reindexes touched ones, so
+        # the same changes are made to a copy of the index.
+        index = dict(self.index)
+        keep = self.filenamesToKeep_(symlinks)
+        items = set(os.listdir(self.updateDir))
+        for item in items:
+            if item in keep:
+                continue
+            path = os.path.join(self.updateDir, item)
+            if self.re_sha1.match(item):
+                state, st = self.cacheStateForSha1_(item)
+                if state in ("unindexed", "touched"):
+                    entry = dict(index.get(item, {}))
+                    entry.pop("verifiedAt", None)
+                    entry["size"] = st.st_size
+                    entry["mtime"] = st.st_mtime
+                    index[item] = entry
+                if state not in ("missing", "resized"):
+                    unreferenced.append(item)
+                    continue
+            reclaimed += os.lstat(path).st_size
+            removed.append(item)
+        # Referenced files are removed by isCached_ if their size changed.
+        for sha1 in symlinks.iterkeys():
+            if sha1 in items and self.cacheStateForSha1_(sha1)[0] == "resized":
+                reclaimed += os.lstat(self.cachePath_(sha1)).st_size
+                removed.append(sha1)
+        for sha1 in self.unreferencedToEvict_index_(unreferenced, index):
+            reclaimed += index[sha1]["size"]
+            removed.append(sha1)
+        return reclaimed, removed
+    
+    def filenamesToKeep_(self, symlinks):
+        # Partial downloads of referenced updates are kept so they can be
+        # resumed.
         filenames = set()
         for sha1, name in symlinks.iteritems():
-            names[name] = sha1
             filenames.add(name)
             filenames.add(sha1)
-        
-        for item in os.listdir(self.updateDir):
+            filenames.add(os.path.basename(self.cacheTmpPath_(sha1)))
+        return filenames
+    
+    def updateLink_name_exists_(self, sha1, name, exists):
+        linkPath = os.path.join(self.updateDir, name)
+        target = None
+        if exists:
             try:
-                itempath = os.path.join(self.updateDir, item)
-                if item not in filenames:
-                    LogInfo("Removing %@", item)
-                    os.unlink(itempath)
-            except OSError as e:
-                LogWarning("Cache pruning of %@ failed: %@", item, str(e))
-        for sha1 in symlinks.iterkeys():
-            sha1Path = self.cachePath_(sha1)
-            linkPath = self.updatePath_(sha1)
-            name = os.path.basename(linkPath)
-            if os.path.exists(sha1Path):
-                if os.path.lexists(linkPath):
-                    if os.readlink(linkPath) == sha1:
-                        LogInfo("Found %@ -> %@", name, sha1)
-                        continue
-                    LogInfo("Removing stale link %@ -> %@", name, os.readlink(linkPath))
-                    try:
-                        os.unlink(linkPath)
-                    except OSError as e:
-                        LogWarning("Cache pruning of %@ failed: %@", name, str(c))
-                        continue
-                LogInfo("Creating %@ -> %@", name, sha1)
-                os.symlink(sha1, linkPath)
+                target = os.readlink(linkPath)
+            except OSError:
+                pass
+        if self.isCached_(sha1):
+            if target == sha1:
+                LogDebug("Found %@ -> %@", name, sha1)
+                return
+            if exists and not self.removeLink_(name):
+                return
+            LogInfo("Creating %@ -> %@", name, sha1)
+            os.symlink(sha1, linkPath)
+        elif exists:
+            self.removeLink_(name)
+    
+    def removeLink_(self, name):
+        linkPath = os.path.join(self.updateDir, name)
+        if not os.path.lexists(linkPath):
+            return True
+        LogInfo("Removing stale link %@", name)
+        return self.removeFile_(linkPath)
+    
+    def removeFile_(self, path):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return True
+            LogWarning("Cache pruning of %@ failed: %@", os.path.basename(path), str(e))
+            return False
+        return True
+    
+    def unreferencedToEvict_index_(self, sha1s, index):
+        """Return the unreferenced updates that don't fit in the budget,
+        least recently used first, according to index. Entries for files
+        that no longer exist are dropped from index."""
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        budget = max(0, defaults.integerForKey_("UpdateCacheUnreferencedBudget"))
+        
+        # Updates deleted outside of AutoDMG don't take up any space.
+        present = list()
+        for sha1 in sha1s:
+            if os.path.exists(self.cachePath_(sha1)):
+                present.append(sha1)
             else:
-                if os.path.lexists(linkPath):
-                    LogInfo("Removing stale link %@ -> %@", name, os.readlink(linkPath))
-                    try:
-                        os.unlink(linkPath)
-                    except OSError as e:
-                        LogWarning("Cache pruning of %@ failed: %@", name, str(c))
-            
+                LogInfo("Dropping %@ from the index, it's no longer cached", sha1)
+                del index[sha1]
+                if index is self.index:
+                    self.indexChanged = True
+        
+        def lastUsed(sha1):
+            entry = index[sha1]
+            date = entry.get("lastUsed") or entry.get("verifiedAt")
+            return date.timeIntervalSince1970() if date else entry["mtime"]
+        
+        keptSize = 0
+        evict = list()
+        for sha1 in sorted(present, key=lastUsed, reverse=True):
+            size = index[sha1]["size"]
+            if not evict and keptSize + size <= budget:
+                keptSize += size
+            else:
+                evict.insert(0, sha1)
+        if keptSize:
+            LogInfo("Keeping %@ of unreferenced updates", IEDUtil.formatByteSize_(keptSize))
+        return evict
+    
+    def evict_(self, sha1):
+        LogInfo("Evicting unreferenced %@", sha1)
+        if self.removeFile_(self.cachePath_(sha1)):
+            del self.index[sha1]
+            self.indexChanged = True
+    
+    def markPackagesUsed_(self, packages):
+        """Record that cached updates are being used by a build."""
+        
+        now = NSDate.date()
+        for package in packages:
+            if package.sha1() in self.index:
+                self.index[package.sha1()]["lastUsed"] = now
+                self.indexChanged = True
+        self.saveIndex()
+    
+    # The index records the size and mtime of each cached file, when its
+    # sha1 was last verified, and when it was last used in a build, so that
+    # a damaged or replaced file is caught with a stat instead of a full
+    # hash. It also remembers the links and profile PublicationDate of the
+    # last prune, for incremental pruning.
+    
+    def loadIndex(self):
+        self.index = dict()
+        self.indexChanged = False
+        self.prunedLinks = None
+        self.prunedPublicationDate = None
+        if not os.path.exists(self.indexPath):
+            return
+        plist = NSDictionary.dictionaryWithContentsOfFile_(self.indexPath)
+        if plist is None or "Files" not in plist:
+            LogWarning("Couldn't read cache index %@, rebuilding it", self.indexPath)
+            return
+        for sha1, entry in plist["Files"].iteritems():
+            self.index[sha1] = dict(entry)
+        if "Links" in plist:
+            self.prunedLinks = dict(plist["Links"])
+        self.prunedPublicationDate = plist.get("PublicationDate")
+    
+    def saveIndex(self):
+        if not self.indexChanged:
+            return
+        files = NSMutableDictionary.dictionary()
+        for sha1, entry in self.index.iteritems():
+            files[sha1] = NSDictionary.dictionaryWithDictionary_(entry)
+        plist = NSMutableDictionary.dictionary()
+        plist["Files"] = files
+        if self.prunedLinks is not None:
+            plist["Links"] = NSDictionary.dictionaryWithDictionary_(self.prunedLinks)
+        if self.prunedPublicationDate is not None:
+            plist["PublicationDate"] = self.prunedPublicationDate
+        if plist.writeToFile_atomically_(self.indexPath, True):
+            self.indexChanged = False
+        else:
+            LogError("Failed to write %@", self.indexPath)
+    
+    def indexFile_verified_(self, sha1, verified):
+        """Record the size and mtime of a file in the cache, and optionally
+        that its checksum was just verified."""
+        
+        st = os.stat(self.cachePath_(sha1))
+        entry = {
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+        }
+        if verified:
+            entry["verifiedAt"] = NSDate.date()
+        if "lastUsed" in self.index.get(sha1, {}):
+            entry["lastUsed"] = self.index[sha1]["lastUsed"]
+        self.index[sha1] = entry
+        self.indexChanged = True
+    
+    def cachedSha1s(self):
+        """Return the sha1 of every complete file in the cache."""
+        
+        return list(item for item in os.listdir(self.updateDir)
+                    if self.re_sha1.match(item) and not os.path.islink(self.cachePath_(item)))
+    
+    def quarantine_(self, sha1):
+        """Move a damaged file out of the cache, keeping it for inspection."""
+        
+        if not os.path.exists(self.quarantineDir):
+            os.makedirs(self.quarantineDir)
+        path = os.path.join(self.quarantineDir, sha1)
+        os.rename(self.cachePath_(sha1), path)
+        if self.index.pop(sha1, None) is not None:
+            self.indexChanged = True
+        LogWarning("Moved %@ to %@", sha1, path)
+    
+    def cacheStateForSha1_(self, sha1):
+        """Compare a cached file with the index without changing anything.
+        Returns the state and the file's stat result, where the state is
+        "missing", "unindexed", "resized", "touched" (only the mtime
+        changed) or "intact"."""
+        
+        try:
+            st = os.stat(self.cachePath_(sha1))
+        except OSError:
+            return "missing", None
+        entry = self.index.get(sha1)
+        if entry is None:
+            return "unindexed", st
+        if entry["size"] != st.st_size:
+            return "resized", st
+        if entry["mtime"] != st.st_mtime:
+            return "touched", st
+        return "intact", st
     
     def isCached_(self, sha1):
-        return os.path.exists(self.cachePath_(sha1))
+        state, st = self.cacheStateForSha1_(sha1)
+        if state == "missing":
+            if self.index.pop(sha1, None) is not None:
+                self.indexChanged = True
+            return False
+        if state == "unindexed":
+            # Cached before there was an index, trust it as before.
+            self.indexFile_verified_(sha1, False)
+            return True
+        if state == "resized":
+            LogWarning("%@ changed size after it was cached, removing it", sha1)
+            try:
+                os.unlink(self.cachePath_(sha1))
+            except OSError as e:
+                LogWarning("Can't remove %@: %@", self.cachePath_(sha1), str(e))
+            del self.index[sha1]
+            self.indexChanged = True
+            return False
+        if state == "touched":
+            # Copying or restoring the cache often doesn't preserve mtimes,
+            # so keep the file but leave it to verify-cache to check it.
+            LogInfo("%@ has a new mtime, marking it as unverified", sha1)
+            self.indexFile_verified_(sha1, False)
+        return True
     
     def updatePath_(self, sha1):
         return os.path.join(self.updateDir, self.symlinks[sha1])
@@ -116,123 +397,286 @@ class IEDUpdateCache(NSObject):
     def cacheTmpPath_(self, sha1):
         return os.path.join(self.updateDir, sha1 + ".part")
     
+    def importFile_sha1_(self, path, sha1):
+        """Add an existing file with a known sha1 to the cache, as a hardlink
+        if the filesystem allows it, or as a copy otherwise."""
+        
+        cachePath = self.cachePath_(sha1)
+        try:
+            os.link(path, cachePath)
+            LogInfo("Linked %@ into cache as %@", path, sha1)
+            self.indexFile_verified_(sha1, True)
+            self.saveIndex()
+            return True
+        except OSError as e:
+            if e.errno not in IEDUtil.LINK_FALLBACK_ERRNOS:
+                LogError("Couldn't link %@ into cache: %@", path, str(e))
+                return False
+        tmpPath = self.cacheTmpPath_(sha1)
+        try:
+            shutil.copyfile(path, tmpPath)
+            os.rename(tmpPath, cachePath)
+        except (IOError, OSError) as e:
+            LogError("Couldn't copy %@ into cache: %@", path, str(e))
+            try:
+                os.unlink(tmpPath)
+            except OSError:
+                pass
+            return False
+        LogInfo("Copied %@ into cache as %@", path, sha1)
+        self.indexFile_verified_(sha1, True)
+        self.saveIndex()
+        return True
+    
+    def downloadURLsForPackage_(self, package):
+        """Return the URLs to try for an update, in order.
+        
+        Each entry in UpdateMirrors is either the base URL of a server, or the
+        path to a shared directory, that has cached updates named by sha1.
+        The upstream URL from the profile is always tried last."""
+        
+        urls = list()
+        for mirror in self.mirrors:
+            if mirror.startswith("/") or mirror.startswith("file:"):
+                if mirror.startswith("file:"):
+                    mirror = NSURL.URLWithString_(mirror).path()
+                path = os.path.join(os.path.expanduser(mirror), package.sha1())
+                if os.path.exists(path):
+                    urls.append(NSURL.fileURLWithPath_(path).absoluteString())
+            else:
+                urls.append("%s/%s" % (mirror.rstrip("/"), package.sha1()))
+        urls.append(package.url())
+        return urls
+    
     
     
     # Download updates to cache.
     #
+    # Updates are transferred by IEDUpdateDownload objects, with up to
+    # UpdateDownloadConcurrency downloads running at the same time. Failed
+    # downloads are retried according to IEDRetryPolicy, and an update that
+    # runs out of attempts fails on its own without stopping the others.
+    # IEDDownloadScheduler limits the bandwidth, and pauses downloads outside
+    # of the configured download windows. Paused downloads resume from their
+    # .part files, without being announced again.
+    #
     # Delegate methods:
     #
     #     - (void)downloadAllDone
     #     - (void)downloadStarting:(NSDictionary *)update
+    #     - (void)downloadStarted:(NSDictionary *)update
+    #     - (void)downloadStopped:(NSDictionary *)update
+    #     - (void)downloadPaused:(NSDictionary *)update
     #     - (void)downloadGotData:(NSDictionary *)update bytesRead:(NSString *)bytes
+    #     - (void)downloadRetrying:(NSDictionary *)update attempt:(int)attempt error:(NSString *)message
     #     - (void)downloadSucceeded:(NSDictionary *)update
     #     - (void)downloadFailed:(NSDictionary *)update withError:(NSString *)message
     
-    def downloadUpdates_(self, updates):
-        self.updates = updates
-        self.downloadNextUpdate()
+    def setRateLimit_(self, rateLimit):
+        """Override UpdateDownloadRateLimit, in bytes per second."""
+        self.rateLimit = rateLimit
     
-    def stopDownload(self):
-        self.connection.cancel()
-        self.delegate.downloadStopped_(self.package)
-        self.delegate.downloadAllDone()
+    def downloadUpdates_(self, updates):
+        defaults = NSUserDefaults.standardUserDefaults()
+        self.maxConcurrentDownloads = max(1, defaults.integerForKey_("UpdateDownloadConcurrency"))
+        self.retryPolicy = IEDRetryPolicy.alloc().init()
+        self.scheduler = IEDDownloadScheduler.alloc().initWithRateLimit_(self.rateLimit)
+        self.mirrors = defaults.stringArrayForKey_("UpdateMirrors") or list()
+        if self.mirrors:
+            LogInfo("Trying update mirrors: %@", ", ".join(self.mirrors))
+        self.progressThrottle.reset()
+        # Start with the largest updates so the long transfers overlap with
+        # the small ones instead of running alone at the end.
+        self.pendingDownloads = sorted(updates, key=lambda package: package.size(), reverse=True)
+        self.activeDownloads = list()
+        self.retryTimers = dict()
+        self.downloadAttempts = dict()
+        self.pausedDownloads = set()
+        self.downloadStartTime = time.time()
+        self.bytesDownloaded = 0
+        self.downloading = True
+        LogInfo("Downloading %d updates, %d at a time", len(self.pendingDownloads), self.maxConcurrentDownloads)
+        self.startPendingDownloads()
     
-    def downloadNextUpdate(self):
-        if self.updates:
-            self.package = self.updates.pop(0)
-            self.bytesReceived = 0
-            self.checksum = hashlib.sha1()
-            self.delegate.downloadStarting_(self.package)
-            
-            path = self.cacheTmpPath_(self.package.sha1())
-            if not NSFileManager.defaultManager().createFileAtPath_contents_attributes_(path, None, None):
-                error = "Couldn't create temporary file at %s" % path
-                self.delegate.downloadFailed_withError_(self.package, error)
-                return
-            self.fileHandle = NSFileHandle.fileHandleForWritingAtPath_(path)
-            if not self.fileHandle:
-                error = "Couldn't open %s for writing" % path
-                self.delegate.downloadFailed_withError_(self.package, error)
+    def startPendingDownloads(self):
+        if self.downloading and self.scheduler.hasWindows():
+            self.scheduleWindowTimer()
+            if not self.scheduler.isInWindow():
                 return
-            
-            LogDebug("Downloading %@ from %@", self.package.name(), self.package.url())
-            url = NSURL.URLWithString_(self.package.url())
-            request = NSURLRequest.requestWithURL_(url)
-            self.connection = NSURLConnection.connectionWithRequest_delegate_(request, self)
-            if self.connection:
-                self.delegate.downloadStarted_(self.package)
-        else:
+        while self.downloading and \
+              self.pendingDownloads and \
+              len(self.activeDownloads) < self.maxConcurrentDownloads:
+            package = self.pendingDownloads.pop(0)
+            download = IEDUpdateDownload.alloc().initWithPackage_cache_(package, self)
+            self.activeDownloads.append(download)
+            if package.sha1() in self.pausedDownloads:
+                # Resuming after a pause isn't a new attempt.
+                self.pausedDownloads.discard(package.sha1())
+            else:
+                self.downloadAttempts[package.sha1()] = self.downloadAttempts.get(package.sha1(), 0) + 1
+                if self.downloadAttempts[package.sha1()] == 1:
+                    self.delegate.downloadStarting_(package)
+            download.start()
+        if self.downloading and not (self.pendingDownloads or self.activeDownloads or self.retryTimers):
+            self.downloading = False
+            self.invalidateWindowTimer()
+            self.recordThroughput()
             self.delegate.downloadAllDone()
     
-    def connection_didFailWithError_(self, connection, error):
-        LogError("%@ failed: %@", self.package.name(), error)
-        self.delegate.downloadStopped_(self.package)
-        self.fileHandle.closeFile()
-        self.delegate.downloadFailed_withError_(self.package, error.localizedDescription())
-        self.delegate.downloadAllDone()
+    def recordThroughput(self):
+        # Remember how fast the last batch of downloads was, for estimates.
+        elapsed = time.time() - self.downloadStartTime
+        if self.bytesDownloaded and elapsed >= 1.0:
+            throughput = self.bytesDownloaded / elapsed
+            LogInfo("Downloaded %@ at %@/s", IEDUtil.formatByteSize_(self.bytesDownloaded),
+                                              IEDUtil.formatByteSize_(throughput))
+            defaults = NSUserDefaults.standardUserDefaults()
+            defaults.setDouble_forKey_(throughput, "LastUpdateDownloadThroughput")
     
-    def connection_didReceiveResponse_(self, connection, response):
-        LogDebug("%@ status code %d", self.package.name(), response.statusCode())
-        if response.statusCode() >= 400:
-            connection.cancel()
-            self.fileHandle.closeFile()
-            error = "%s failed with HTTP %d" % (self.package.name(), response.statusCode())
-            self.delegate.downloadFailed_withError_(self.package, error)
-            self.delegate.downloadAllDone()
+    def expectedDownloadTime_(self, size):
+        """Estimate the seconds needed to download size bytes, from the
+        throughput of the last downloads and the rate limit. Returns None if
+        there is nothing to base it on."""
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        throughput = defaults.doubleForKey_("LastUpdateDownloadThroughput")
+        rateLimit = self.rateLimit
+        if rateLimit is None:
+            rateLimit = defaults.integerForKey_("UpdateDownloadRateLimit")
+        if rateLimit > 0:
+            throughput = min(throughput, rateLimit) if throughput > 0.0 else rateLimit
+        if throughput <= 0.0:
+            return None
+        return size / throughput
     
-    def connection_willSendRequest_redirectResponse_(self, connection, request, response):
-        try:
-            if response:
-                url = response.URL()
-                code = response.statusCode()
-                LogDebug("%d redirect to %@", code, url)
-        except BaseException as e:
-            LogDebug("Exception: %@", repr(e))
-        return request
-
-    def connection_didReceiveData_(self, connection, data):
+    def scheduleWindowTimer(self):
+        if self.windowTimer:
+            return
+        delay = self.scheduler.secondsUntilWindowChange()
+        if delay is None:
+            return
+        if not self.scheduler.isInWindow():
+            LogNotice("Outside of download window, waiting %d minutes", (delay + 59) // 60)
+        self.windowTimer = NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(delay,
+                                                                                                    self,
+                                                                                                    self.windowChanged_,
+                                                                                                    None,
+                                                                                                    False)
+    
+    def invalidateWindowTimer(self):
+        if self.windowTimer:
+            self.windowTimer.invalidate()
+            self.windowTimer = None
+    
+    def windowChanged_(self, timer):
+        self.windowTimer = None
+        if not self.downloading:
+            return
+        if self.scheduler.isInWindow():
+            LogNotice("Download window opened, resuming downloads")
+        else:
+            LogNotice("Download window closed, pausing %d downloads", len(self.activeDownloads))
+            for download in reversed(self.activeDownloads):
+                download.cancel()
+                self.pausedDownloads.add(download.package.sha1())
+                self.pendingDownloads.insert(0, download.package)
+                self.delegate.downloadPaused_(download.package)
+            self.activeDownloads = list()
+        self.startPendingDownloads()
+    
+    def stopDownload(self):
+        self.abortDownloads()
+    
+    def abortDownloads(self):
+        self.downloading = False
+        self.pendingDownloads = list()
+        self.pausedDownloads = set()
+        self.invalidateWindowTimer()
+        for timer in self.retryTimers.itervalues():
+            timer.invalidate()
+        self.retryTimers = dict()
+        for download in self.activeDownloads:
+            download.cancel()
+            self.delegate.downloadStopped_(download.package)
+        self.activeDownloads = list()
+        self.delegate.downloadAllDone()
+    
+    def removeDownload_(self, download):
         try:
-            self.fileHandle.writeData_(data)
-        except BaseException as e:
-            LogError("Write error: %@", str(e))
-            connection.cancel()
-            error = "Writing to %s failed: %s" % (self.cacheTmpPath_(self.package.sha1()), str(e))
-            self.fileHandle.closeFile()
-            self.delegate.downloadFailed_withError_(self.package, error)
-            self.delegate.downloadAllDone()
+            self.activeDownloads.remove(download)
+        except ValueError:
+            pass
+    
+    def retryDownload_(self, timer):
+        package = timer.userInfo()
+        self.retryTimers.pop(package.sha1(), None)
+        # Retries go to the front of the queue so an update that was halfway
+        # done doesn't have to wait for everything else.
+        self.pendingDownloads.insert(0, package)
+        self.startPendingDownloads()
+    
+    # IEDUpdateDownload callbacks.
+    
+    def downloadDidStart_(self, download):
+        self.progressThrottle.forgetKey_(download.package.sha1())
+        self.delegate.downloadStarted_(download.package)
+    
+    def download_didReceiveBytes_(self, download, bytesReceived):
+        package = download.package
+        if self.progressThrottle.shouldReportProgress_ofTotal_forKey_(bytesReceived, package.size(), package.sha1()):
+            self.delegate.downloadGotData_bytesRead_(package, bytesReceived)
+    
+    def download_didFailWithError_retryable_(self, download, error, retryable):
+        package = download.package
+        self.removeDownload_(download)
+        self.delegate.downloadStopped_(package)
+        if not self.downloading:
             return
-        self.checksum.update(data)
-        self.bytesReceived += data.length()
-        self.delegate.downloadGotData_bytesRead_(self.package, self.bytesReceived)
-    
-    def connectionDidFinishLoading_(self, connection):
-        LogInfo("%@ finished downloading to %@", self.package.name(), self.cacheTmpPath_(self.package.sha1()))
-        self.fileHandle.closeFile()
-        self.delegate.downloadStopped_(self.package)
-        if self.checksum.hexdigest() == self.package.sha1():
-            try:
-                os.rename(self.cacheTmpPath_(self.package.sha1()),
-                          self.cachePath_(self.package.sha1()))
-            except OSError as e:
-                error = "Failed when moving download to %s: %s" % (self.cachePath_(self.package.sha1()), str(e))
-                LogError(error)
-                self.delegate.downloadFailed_withError_(self.package, error)
-                return
-            linkPath = self.updatePath_(self.package.sha1())
-            try:
-                os.symlink(self.package.sha1(), linkPath)
-            except OSError as e:
-                error = "Failed when creating link from %s to %s: %s" % (self.package.sha1(),
-                                                                          linkPath,
-                                                                          str(e))
-                LogError(error)
-                self.delegate.downloadFailed_withError_(self.package, error)
-                return
-            LogNotice("%@ added to cache with sha1 %@", self.package.name(), self.package.sha1())
-            self.delegate.downloadSucceeded_(self.package)
-            self.downloadNextUpdate()
+        attempt = self.downloadAttempts[package.sha1()]
+        if retryable and self.retryPolicy.shouldRetryAttempt_(attempt):
+            delay = self.retryPolicy.delayForAttempt_(attempt)
+            LogWarning("Attempt %d of %d for %@ failed, retrying in %.1f seconds: %@",
+                       attempt, self.retryPolicy.maxAttempts, package.name(), delay, error)
+            self.delegate.downloadRetrying_attempt_error_(package, attempt + 1, error)
+            timer = NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(delay,
+                                                                                             self,
+                                                                                             self.retryDownload_,
+                                                                                             package,
+                                                                                             False)
+            self.retryTimers[package.sha1()] = timer
         else:
-            error = "Expected sha1 checksum %s but got %s" % (self.package.sha1().lower(), self.checksum.hexdigest().lower())
+            if retryable:
+                LogError("Giving up on %@ after %d attempts", package.name(), attempt)
+            self.delegate.downloadFailed_withError_(package, error)
+        self.startPendingDownloads()
+    
+    def downloadDidFinish_(self, download):
+        package = download.package
+        self.removeDownload_(download)
+        self.delegate.downloadStopped_(package)
+        try:
+            os.rename(self.cacheTmpPath_(package.sha1()),
+                      self.cachePath_(package.sha1()))
+            self.indexFile_verified_(package.sha1(), True)
+            self.saveIndex()
+        except OSError as e:
+            error = "Failed when moving download to %s: %s" % (self.cachePath_(package.sha1()), str(e))
             LogError(error)
-            self.delegate.downloadFailed_withError_(self.package, error)
-            self.delegate.downloadAllDone()
+            self.delegate.downloadFailed_withError_(package, error)
+            self.startPendingDownloads()
+            return
+        linkPath = self.updatePath_(package.sha1())
+        try:
+            os.symlink(package.sha1(), linkPath)
+        except OSError as e:
+            error = "Failed when creating link from %s to %s: %s" % (package.sha1(),
+                                                                      linkPath,
+                                                                      str(e))
+            LogError(error)
+            self.delegate.downloadFailed_withError_(package, error)
+            self.startPendingDownloads()
+            return
+        LogNotice("%@ added to cache with sha1 %@", package.name(), package.sha1())
+        self.bytesDownloaded += package.size()
+        self.delegate.downloadSucceeded_(package)
+        self.startPendingDownloads()
@@ -52,6 +52,8 @@ class IEDUpdateController(NSObject):
         self.updates = list()
         self.downloadTotalSize = 0
         self.downloads = list()
+        self.activeDownloads = set()
+        self.downloadFailures = list()
         self.delegate = None
         self.version = None
         self.build = None
@@ -123,6 +125,8 @@ class IEDUpdateController(NSObject):
             sizeStr = IEDUtil.formatByteSize_(self.downloadTotalSize)
             plurals = "s" if len(self.downloads) >= 2 else ""
             downloadLabel = "%d update%s to download (%s)" % (len(self.downloads), plurals, sizeStr)
+            if self.summary and self.summary["estimatedBuildSeconds"] is not None:
+                downloadLabel += ", ~%s build" % IEDUtil.formatDuration_(self.summary["estimatedBuildSeconds"])
             self.updateTableLabel.setStringValue_(downloadLabel)
             self.updateTableLabel.setEnabled_(True)
             self.updateTableLabel.setTextColor_(NSColor.controlTextColor())
@@ -139,6 +143,9 @@ class IEDUpdateController(NSObject):
                 package.setImage_(self.uncachedImage)
                 self.downloadTotalSize += package.size()
                 self.downloads.append(package)
+        self.summary = None
+        if self.updates:
+            self.summary = self.profileController.summaryForVersion_build_cache_(self.version, self.build, self.cache)
         self.updateTable.reloadData()
         self.showRemainingDownloads()
         self.updateHeight()
@@ -267,7 +274,13 @@ class IEDUpdateController(NSObject):
         self.downloadWindow.makeKeyAndOrderFront_(self)
         self.downloadCounter = 0
         self.downloadNumUpdates = len(self.downloads)
-        self.cache.downloadUpdates_(self.downloads)
+        # Several updates download at the same time, so the progress bar
+        # shows the combined progress of all of them.
+        self.downloadBytesRead = dict()
+        self.activeDownloads = set()
+        self.downloadFailures = list()
+        self.downloadProgressBar.setMaxValue_(self.downloadTotalSize)
+        self.cache.downloadUpdates_(list(self.downloads))
     
     # Act on download stop button being clicked.
     
@@ -285,25 +298,55 @@ class IEDUpdateController(NSObject):
         self.enableControls()
         if self.delegate:
             self.delegate.updateControllerChanged()
+        if self.downloadFailures:
+            # Failures are collected so parallel downloads aren't blocked by
+            # a modal alert for each one.
+            alert = NSAlert.alloc().init()
+            if len(self.downloadFailures) == 1:
+                alert.setMessageText_("Download failed")
+            else:
+                alert.setMessageText_("%d downloads failed" % len(self.downloadFailures))
+            alert.setInformativeText_("\n".join("%s: %s" % (name, message)
+                                                for name, message in self.downloadFailures))
+            self.downloadFailures = list()
+            alert.runModal()
     
     def downloadStarting_(self, package):
         LogDebug("downloadStarting:")
         self.downloadProgressBar.setIndeterminate_(False)
-        self.downloadProgressBar.setDoubleValue_(0.0)
-        self.downloadProgressBar.setMaxValue_(package.size())
         self.downloadCounter += 1
-        self.downloadLabel.setStringValue_("%s (%s)" % (package.name(), IEDUtil.formatByteSize_(package.size())))
+        self.downloadLabel.setStringValue_("%d of %d: %s (%s)" % (self.downloadCounter,
+                                                                  self.downloadNumUpdates,
+                                                                  package.name(),
+                                                                  IEDUtil.formatByteSize_(package.size())))
     
     def downloadStarted_(self, package):
         LogDebug("downloadStarted:")
+        self.activeDownloads.add(package.sha1())
         self.downloadStopButton.setEnabled_(True)
     
     def downloadStopped_(self, package):
         LogDebug("downloadStopped:")
-        self.downloadStopButton.setEnabled_(False)
+        self.activeDownloads.discard(package.sha1())
+        # Other downloads may still be running.
+        if not self.activeDownloads:
+            self.downloadStopButton.setEnabled_(False)
+    
+    def downloadPaused_(self, package):
+        LogDebug("downloadPaused:")
+        # The download stays in activeDownloads, so the run can be stopped
+        # while it waits for the next download window.
+        self.downloadStopButton.setEnabled_(True)
+        self.downloadLabel.setStringValue_("Waiting for download window: %s" % package.name())
     
     def downloadGotData_bytesRead_(self, package, bytes):
-        self.downloadProgressBar.setDoubleValue_(bytes)
+        self.downloadBytesRead[package.sha1()] = bytes
+        self.downloadProgressBar.setDoubleValue_(sum(self.downloadBytesRead.itervalues()))
+    
+    def downloadRetrying_attempt_error_(self, package, attempt, message):
+        LogDebug("downloadRetrying:attempt:error:")
+        self.downloadStopButton.setEnabled_(True)
+        self.downloadLabel.setStringValue_("Retrying %s (attempt %d)" % (package.name(), attempt))
     
     def downloadSucceeded_(self, package):
         LogDebug("downloadSucceeded:")
@@ -313,10 +356,7 @@ class IEDUpdateController(NSObject):
     
     def downloadFailed_withError_(self, package, message):
         LogDebug("downloadFailed:withError:")
-        alert = NSAlert.alloc().init()
-        alert.setMessageText_("Download failed")
-        alert.setInformativeText_(message)
-        alert.runModal()
+        self.downloadFailures.append((package.name(), message))
     
     
     
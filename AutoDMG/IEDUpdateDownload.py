@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDUpdateDownload.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import os
+import re
+import time
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+from IEDUtil import *
+from IEDUpdateWriter import *
+
+
+class IEDUpdateDownload(NSObject):
+    """A single update being transferred into the cache.
+    
+    The update is fetched as one or more byte range segments, each with its
+    own connection. Data is written and hashed by an IEDUpdateWriter in a
+    background thread. With a single segment the sha1 is calculated as the
+    data arrives, with several segments the file is hashed once all of them
+    have landed.
+    
+    Whenever the download isn't running the .part file only contains data
+    that was received in order from the start, so it can be resumed.
+    
+    Mirrors are tried before the upstream URL, and if one fails the download
+    moves on to the next without counting it as a failed attempt.
+    
+    Downloads are created and scheduled by IEDUpdateCache, which is notified
+    of progress with the following methods:
+        
+        - (void)downloadDidStart:(IEDUpdateDownload *)download
+        - (void)download:(IEDUpdateDownload *)download didReceiveBytes:(long long)bytes
+        - (void)downloadDidFinish:(IEDUpdateDownload *)download
+        - (void)download:(IEDUpdateDownload *)download didFailWithError:(NSString *)message retryable:(BOOL)retryable
+    """
+    
+    re_contentrange = re.compile(r'^bytes (?P<start>\d+)-')
+    
+    def initWithPackage_cache_(self, package, cache):
+        self = super(IEDUpdateDownload, self).init()
+        if self is None:
+            return None
+        
+        self.package = package
+        self.cache = cache
+        self.urls = None
+        self.urlIndex = 0
+        self.segments = list()
+        self.writer = None
+        self.streamChecksum = True
+        self.bytesReceived = 0
+        self.startTime = None
+        self.cancelled = False
+        self.resumeTimers = list()
+        self.announced = False
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        self.maxSegments = max(1, defaults.integerForKey_("UpdateDownloadSegments"))
+        self.minSegmentSize = max(1, defaults.integerForKey_("UpdateDownloadSegmentMinSize"))
+        
+        return self
+    
+    def tmpPath(self):
+        return self.cache.cacheTmpPath_(self.package.sha1())
+    
+    def url(self):
+        return self.urls[self.urlIndex]
+    
+    def start(self):
+        if self.urls is None:
+            self.urls = self.cache.downloadURLsForPackage_(self.package)
+        self.segments = list()
+        self.cancelled = False
+        offset = self.partialSize()
+        
+        path = self.tmpPath()
+        if offset == 0:
+            if not NSFileManager.defaultManager().createFileAtPath_contents_attributes_(path, None, None):
+                self.fail_retryable_("Couldn't create temporary file at %s" % path, False)
+                return
+        
+        remaining = self.package.size() - offset
+        numSegments = min(self.maxSegments, max(1, remaining // self.minSegmentSize))
+        if numSegments > 1:
+            self.streamChecksum = False
+            segmentSize = remaining // numSegments
+            for i in range(numSegments):
+                start = offset + i * segmentSize
+                end = self.package.size() if i == numSegments - 1 else start + segmentSize
+                self.segments.append(self.segmentFrom_to_(start, end))
+            LogInfo("Downloading %@ in %d segments", self.package.name(), numSegments)
+        else:
+            self.streamChecksum = True
+            self.segments.append(self.segmentFrom_to_(offset, None))
+        self.bytesReceived = offset
+        
+        for segment in self.segments:
+            segment["fileHandle"] = NSFileHandle.fileHandleForWritingAtPath_(path)
+            if not segment["fileHandle"]:
+                self.fail_retryable_("Couldn't open %s for writing" % path, False)
+                return
+        if len(self.segments) > 1:
+            # Preallocate the whole file so every segment can write at its
+            # own offset.
+            self.segments[0]["fileHandle"].truncateFileAtOffset_(self.package.size())
+        else:
+            self.segments[0]["fileHandle"].truncateFileAtOffset_(offset)
+        for segment in self.segments:
+            segment["fileHandle"].seekToFileOffset_(segment["position"])
+        
+        self.writer = IEDUpdateWriter.alloc().initWithDownload_path_(self, path)
+        if self.streamChecksum and offset:
+            self.writer.hashExistingData_(offset)
+        self.startTime = time.time()
+        
+        # With several segments the first one finds out if the server
+        # supports ranges before the rest are started.
+        self.startSegment_(self.segments[0])
+        # If the connection failed, the next URL was started and announced
+        # before startSegment_ returned.
+        if self.segments and self.segments[0]["connection"] and not self.announced:
+            self.announced = True
+            self.cache.downloadDidStart_(self)
+    
+    def segmentFrom_to_(self, start, end):
+        return {
+            "start": start,
+            "end": end,
+            "position": start,
+            "connection": None,
+            "fileHandle": None,
+            "done": False,
+        }
+    
+    def startSegment_(self, segment):
+        url = NSURL.URLWithString_(self.url())
+        request = NSMutableURLRequest.requestWithURL_(url)
+        if segment["end"] is not None:
+            LogDebug("Downloading bytes %ld-%ld of %@ from %@",
+                     segment["position"], segment["end"] - 1, self.package.name(), self.url())
+            request.setValue_forHTTPHeaderField_("bytes=%d-%d" % (segment["position"], segment["end"] - 1), "Range")
+        elif segment["position"]:
+            LogInfo("Resuming %@ after %@", self.package.name(), IEDUtil.formatByteSize_(segment["position"]))
+            request.setValue_forHTTPHeaderField_("bytes=%d-" % segment["position"], "Range")
+        else:
+            LogDebug("Downloading %@ from %@", self.package.name(), self.url())
+        segment["connection"] = NSURLConnection.connectionWithRequest_delegate_(request, self)
+        if not segment["connection"]:
+            self.fail_retryable_("Couldn't connect to %s" % self.url(), True)
+    
+    def segmentForConnection_(self, connection):
+        for segment in self.segments:
+            if segment["connection"] is connection:
+                return segment
+        return None
+    
+    def partialSize(self):
+        """Return the size of the data left in the .part file by an earlier
+        attempt, or 0 to download from scratch."""
+        
+        try:
+            size = os.path.getsize(self.tmpPath())
+        except OSError:
+            return 0
+        if size >= self.package.size():
+            return 0
+        return size
+    
+    def contiguousSize(self):
+        """Return how much of the file has been received without gaps."""
+        
+        size = 0
+        for segment in self.segments:
+            size = segment["position"]
+            if not segment["done"]:
+                break
+        return size
+    
+    def discardPartialData(self):
+        segment = self.segments[0]
+        self.writer.discardData_(segment["fileHandle"])
+        segment["start"] = segment["position"] = 0
+        self.bytesReceived = 0
+    
+    def fallBackToSingleSegment(self):
+        LogInfo("Server doesn't support ranges, downloading %@ in one segment", self.package.name())
+        self.writer.waitUntilDone()
+        for segment in self.segments[1:]:
+            segment["fileHandle"].closeFile()
+        self.segments = self.segments[:1]
+        self.segments[0]["end"] = None
+        self.streamChecksum = True
+        self.discardPartialData()
+    
+    def removeTmpFile(self):
+        try:
+            os.unlink(self.tmpPath())
+        except OSError as e:
+            LogWarning("Can't remove %@: %@", self.tmpPath(), str(e))
+    
+    def cancel(self):
+        self.cancelled = True
+        for timer in self.resumeTimers:
+            timer.invalidate()
+        self.resumeTimers = list()
+        for segment in self.segments:
+            if segment["connection"]:
+                segment["connection"].cancel()
+                segment["connection"] = None
+        if self.writer:
+            if len(self.segments) > 1 and self.segments[0]["fileHandle"]:
+                # Drop everything after the first gap so the .part file can
+                # be resumed later.
+                self.writer.truncateFileHandle_atOffset_(self.segments[0]["fileHandle"], self.contiguousSize())
+            self.writer.stop()
+            # Let the writer finish before the files are closed, and before
+            # a retry opens the .part file again.
+            self.writer.waitUntilDone()
+            self.writer = None
+        self.closeFiles()
+    
+    def closeFiles(self):
+        for segment in self.segments:
+            if segment["fileHandle"]:
+                segment["fileHandle"].closeFile()
+                segment["fileHandle"] = None
+    
+    def fail_retryable_(self, error, retryable):
+        self.cancel()
+        if self.urlIndex < len(self.urls) - 1:
+            LogWarning("Couldn't download %@ from %@: %@", self.package.name(), self.url(), error)
+            self.urlIndex += 1
+            self.start()
+            return
+        self.cache.download_didFailWithError_retryable_(self, error, retryable)
+    
+    def finish(self):
+        elapsed = time.time() - self.startTime
+        LogInfo("%@ finished downloading to %@", self.package.name(), self.tmpPath())
+        if elapsed > 0.0:
+            LogInfo("Received %@ of %@ in %.1f seconds (%@/s)",
+                    IEDUtil.formatByteSize_(self.bytesReceived),
+                    self.package.name(),
+                    elapsed,
+                    IEDUtil.formatByteSize_(self.bytesReceived / elapsed))
+        # With several segments the file is hashed after the last write.
+        self.writer.finishAndRehash_(not self.streamChecksum)
+    
+    # IEDUpdateWriter callbacks.
+    
+    def writerDidFinish_(self, sha1):
+        if self.cancelled:
+            return
+        self.writer.stop()
+        self.writer = None
+        self.closeFiles()
+        if sha1 == self.package.sha1():
+            self.cache.downloadDidFinish_(self)
+        else:
+            error = "Expected sha1 checksum %s but got %s" % (self.package.sha1().lower(), sha1.lower())
+            LogError(error)
+            # Don't resume from corrupt data next time.
+            self.removeTmpFile()
+            self.fail_retryable_(error, True)
+    
+    def writerFailed_(self, error):
+        if self.cancelled:
+            return
+        self.fail_retryable_(error, False)
+    
+    # NSURLConnection delegate methods.
+    
+    def connection_didFailWithError_(self, connection, error):
+        LogError("%@ failed: %@", self.package.name(), error)
+        segment = self.segmentForConnection_(connection)
+        if segment:
+            segment["connection"] = None
+        self.fail_retryable_(error.localizedDescription(), self.cache.retryPolicy.isRetryableError_(error))
+    
+    def connection_didReceiveResponse_(self, connection, response):
+        segment = self.segmentForConnection_(connection)
+        # Shared directory mirrors are read through file URLs, which always
+        # return the whole file.
+        status = response.statusCode() if response.respondsToSelector_("statusCode") else 200
+        LogDebug("%@ status code %d", self.package.name(), status)
+        if status >= 400 and status != 416:
+            self.fail_retryable_("%s failed with HTTP %d" % (self.package.name(), status),
+                                 self.cache.retryPolicy.isRetryableStatus_(status))
+            return
+        rangeOK = status == 206 and self.contentRangeStart_(response) == segment["position"]
+        
+        if len(self.segments) > 1:
+            if segment is not self.segments[0]:
+                if not rangeOK:
+                    self.fail_retryable_("Segment request for %s failed with HTTP %d" % (self.package.name(), status),
+                                         True)
+                return
+            if rangeOK:
+                LogDebug("Server accepted range for %@, starting %d more segments",
+                         self.package.name(), len(self.segments) - 1)
+                for other in self.segments[1:]:
+                    self.startSegment_(other)
+                return
+            if status == 200:
+                # Use this response as a plain download of the whole file.
+                self.fallBackToSingleSegment()
+                return
+        elif segment["position"]:
+            if rangeOK:
+                LogDebug("Server accepted range for %@", self.package.name())
+                return
+            if status == 200:
+                LogInfo("Server ignored range request for %@, downloading from start", self.package.name())
+                self.discardPartialData()
+                return
+        else:
+            if status == 200 or rangeOK:
+                return
+            # A 416 without a range, or any other status we don't handle,
+            # has an error page as its body, which mustn't end up in the
+            # .part file.
+            connection.cancel()
+            segment["connection"] = None
+            self.discardPartialData()
+            self.fail_retryable_("%s failed with HTTP %d" % (self.package.name(), status), True)
+            return
+        
+        # The server didn't honor the range we asked for, so start over with
+        # a request for the whole file.
+        LogWarning("Range request for %@ failed with HTTP %d, downloading from start", self.package.name(), status)
+        connection.cancel()
+        segment["connection"] = None
+        if len(self.segments) > 1:
+            self.fallBackToSingleSegment()
+        else:
+            self.discardPartialData()
+        self.startSegment_(self.segments[0])
+    
+    def contentRangeStart_(self, response):
+        for key, value in response.allHeaderFields().iteritems():
+            if key.lower() == "content-range":
+                m = self.re_contentrange.match(value)
+                if m:
+                    return int(m.group("start"))
+        return None
+    
+    def connection_willSendRequest_redirectResponse_(self, connection, request, response):
+        try:
+            if response:
+                url = response.URL()
+                code = response.statusCode()
+                LogDebug("%d redirect to %@", code, url)
+        except BaseException as e:
+            LogDebug("Exception: %@", repr(e))
+        return request
+    
+    def connection_didReceiveData_(self, connection, data):
+        segment = self.segmentForConnection_(connection)
+        if segment["end"] is not None and segment["position"] + data.length() > segment["end"]:
+            self.fail_retryable_("Server sent more data than requested for %s" % self.package.name(), True)
+            return
+        self.writer.writeData_toFileHandle_hash_(data, segment["fileHandle"], self.streamChecksum)
+        segment["position"] += data.length()
+        self.bytesReceived += data.length()
+        self.cache.download_didReceiveBytes_(self, self.bytesReceived)
+        delay = self.cache.scheduler.delayForBytes_(data.length())
+        if delay > 0.0:
+            self.pauseConnection_forInterval_(connection, delay)
+    
+    def pauseConnection_forInterval_(self, connection, delay):
+        # Taking the connection off the run loop stops it from delivering
+        # data, which slows down the transfer.
+        connection.unscheduleFromRunLoop_forMode_(NSRunLoop.currentRunLoop(), NSDefaultRunLoopMode)
+        timer = NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(delay,
+                                                                                         self,
+                                                                                         self.resumeConnection_,
+                                                                                         connection,
+                                                                                         False)
+        self.resumeTimers.append(timer)
+    
+    def resumeConnection_(self, timer):
+        self.resumeTimers.remove(timer)
+        connection = timer.userInfo()
+        if self.segmentForConnection_(connection):
+            connection.scheduleInRunLoop_forMode_(NSRunLoop.currentRunLoop(), NSDefaultRunLoopMode)
+    
+    def connectionDidFinishLoading_(self, connection):
+        segment = self.segmentForConnection_(connection)
+        segment["connection"] = None
+        if segment["end"] is not None and segment["position"] != segment["end"]:
+            self.fail_retryable_("Segment of %s ended early" % self.package.name(), True)
+            return
+        segment["done"] = True
+        if all(x["done"] for x in self.segments):
+            self.finish()
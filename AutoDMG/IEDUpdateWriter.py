@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+#  IEDUpdateWriter.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+from CocoaWrapper import *
+import Queue
+import hashlib
+import time
+
+from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
+from IEDUtil import *
+
+
+class IEDUpdateWriter(NSObject):
+    """Write and hash downloaded data in a background thread.
+    
+    Data is passed from the connection delegate through a bounded queue, so
+    receiving, writing and hashing overlap, and a slow disk slows down the
+    download instead of filling up memory. Results are passed back to the
+    download on the main thread:
+        
+        - (void)writerDidFinish:(NSString *)sha1
+        - (void)writerFailed:(NSString *)message
+    """
+    
+    QUEUE_DEPTH = 256
+    HASH_CHUNK_SIZE = 4 * 1024 * 1024
+    
+    def initWithDownload_path_(self, download, path):
+        self = super(IEDUpdateWriter, self).init()
+        if self is None:
+            return None
+        
+        self.download = download
+        self.path = path
+        self.queue = Queue.Queue(IEDUpdateWriter.QUEUE_DEPTH)
+        self.checksum = hashlib.sha1()
+        self.error = None
+        self.bytesWritten = 0
+        self.bytesHashed = 0
+        self.busyTime = 0.0
+        
+        self.thread = NSThread.alloc().initWithTarget_selector_object_(self, "writeInBackground:", None)
+        self.thread.start()
+        
+        return self
+    
+    # Methods called from the main thread.
+    
+    def hashExistingData_(self, size):
+        self.queue.put(("hash", size))
+    
+    def writeData_toFileHandle_hash_(self, data, fileHandle, shouldHash):
+        self.queue.put(("write", data, fileHandle, shouldHash))
+    
+    def truncateFileHandle_atOffset_(self, fileHandle, offset):
+        self.queue.put(("truncate", fileHandle, offset))
+    
+    def discardData_(self, fileHandle):
+        self.queue.put(("discard", fileHandle))
+    
+    def finishAndRehash_(self, rehash):
+        self.queue.put(("finish", rehash))
+    
+    def waitUntilDone(self):
+        self.queue.join()
+    
+    def stop(self):
+        self.queue.put(("stop",))
+    
+    # Background thread.
+    
+    def writeInBackground_(self, ignored):
+        while True:
+            item = self.queue.get()
+            try:
+                command = item[0]
+                if command == "stop":
+                    break
+                if self.error:
+                    continue
+                startTime = time.time()
+                if command == "write":
+                    data, fileHandle, shouldHash = item[1:]
+                    fileHandle.writeData_(data)
+                    self.bytesWritten += data.length()
+                    if shouldHash:
+                        self.checksum.update(data)
+                        self.bytesHashed += data.length()
+                elif command == "hash":
+                    self.hashFile_(item[1])
+                elif command == "truncate":
+                    fileHandle, offset = item[1:]
+                    fileHandle.truncateFileAtOffset_(offset)
+                elif command == "discard":
+                    item[1].truncateFileAtOffset_(0)
+                    self.checksum = hashlib.sha1()
+                elif command == "finish":
+                    if item[1]:
+                        self.checksum = hashlib.sha1()
+                        self.hashFile_(None)
+                    self.busyTime += time.time() - startTime
+                    self.logThroughput()
+                    self.download.performSelectorOnMainThread_withObject_waitUntilDone_("writerDidFinish:",
+                                                                                         self.checksum.hexdigest(),
+                                                                                         False)
+                    continue
+                self.busyTime += time.time() - startTime
+            except BaseException as e:
+                self.error = "Writing to %s failed: %s" % (self.path, str(e))
+                LogError("%@", self.error)
+                self.download.performSelectorOnMainThread_withObject_waitUntilDone_("writerFailed:",
+                                                                                     self.error,
+                                                                                     False)
+            finally:
+                self.queue.task_done()
+    
+    def hashFile_(self, size):
+        with open(self.path, "rb") as f:
+            while size is None or size > 0:
+                chunkSize = IEDUpdateWriter.HASH_CHUNK_SIZE if size is None else min(size, IEDUpdateWriter.HASH_CHUNK_SIZE)
+                data = f.read(chunkSize)
+                if not data:
+                    break
+                self.checksum.update(data)
+                self.bytesHashed += len(data)
+                if size is not None:
+                    size -= len(data)
+    
+    def logThroughput(self):
+        if self.busyTime > 0.0:
+            LogInfo("Wrote %@ and hashed %@ of %@ in %.1f seconds (%@/s)",
+                    IEDUtil.formatByteSize_(self.bytesWritten),
+                    IEDUtil.formatByteSize_(self.bytesHashed),
+                    self.download.package.name(),
+                    self.busyTime,
+                    IEDUtil.formatByteSize_(self.bytesHashed / self.busyTime))
@@ -12,6 +12,8 @@ from __future__ import unicode_literals
 from CocoaWrapper import *
 
 import os.path
+import errno
+import hashlib
 import subprocess
 import tempfile
 import shutil
@@ -24,6 +26,9 @@ class IEDUtil(NSObject):
     
     VERSIONPLIST_PATH = "System/Library/CoreServices/SystemVersion.plist"
     PACKAGE_EXTENSIONS = [".pkg", ".mpkg", ".app", ".dmg"]
+    # Errors from os.link() that mean the file should be copied instead:
+    # another volume, or a volume that doesn't do hard links.
+    LINK_FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EMLINK)
     
     @classmethod
     def readSystemVersion_(cls, rootPath):
@@ -138,6 +143,18 @@ class IEDUtil(NSObject):
         else:
             return int(out.split()[0]) * 1024
     
+    @classmethod
+    def sha1ForFile_(cls, path):
+        """Return the hex sha1 digest of a file's contents."""
+        checksum = hashlib.sha1()
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(4 * 1024 * 1024)
+                if not data:
+                    break
+                checksum.update(data)
+        return checksum.hexdigest()
+    
     @classmethod
     def formatByteSize_(cls, size):
         size = float(size)
@@ -147,6 +164,17 @@ class IEDUtil(NSObject):
             unitIndex += 1
         return "%.1f %s" % (size, ("bytes", "kB", "MB", "GB", "TB")[unitIndex])
     
+    @classmethod
+    def formatDuration_(cls, seconds):
+        seconds = int(seconds)
+        if seconds < 60:
+            return "%d s" % seconds
+        elif seconds < 3600:
+            return "%d min" % ((seconds + 30) // 60)
+        else:
+            minutes = (seconds + 30) // 60
+            return "%d h %d min" % (minutes // 60, minutes % 60)
+    
     @classmethod
     def findMountPoint_(cls, path):
         path = os.path.abspath(path)
@@ -19,12 +19,17 @@ import time
 import tempfile
 import shutil
 import datetime
+import hashlib
 
 from IEDLog import LogDebug, LogInfo, LogNotice, LogWarning, LogError, LogMessage
 from IEDUtil import *
 from IEDSocketListener import *
 from IEDDMGHelper import *
 from IEDTemplate import *
+from IEDProgressThrottle import *
+from IEDBuildTelemetry import *
+from IEDBuildETA import *
+from IEDBuildCache import *
 from Foundation import STPrivilegedTask
 
 
@@ -57,6 +62,7 @@ class IEDWorkflow(NSObject):
         self.additionalPackages = list()
         self.attachedPackageDMGs = dict()
         self.lastUpdateMessage = None
+        self.progressThrottle = IEDProgressThrottle.alloc().init()
         self._authUsername = None
         self._authPassword = None
         self._volumeSize = None
@@ -66,6 +72,9 @@ class IEDWorkflow(NSObject):
         self.tempDir = None
         self.templatePath = None
         self.sourceType = None
+        self.layeredBasePath = None
+        self.layeredBaseCount = 0
+        self.layeredBaseExists = False
         
         return self
     
@@ -413,6 +422,7 @@ class IEDWorkflow(NSObject):
     #     - (void)buildSetTotalWeight:(double)totalWeight
     #     - (void)buildSetPhase:(NSString *)phase
     #     - (void)buildSetProgress:(double)progress
+    #     - (void)buildSetRemainingSeconds:(double)seconds throughput:(double)bytesPerSecond
     #     - (void)buildSetProgressMessage:(NSString *)message
     #     - (void)buildSucceeded
     #     - (void)buildFailed:(NSString *)message details:(NSString *)details
@@ -424,6 +434,8 @@ class IEDWorkflow(NSObject):
         LogNotice("Using output path: %@", self.outputPath())
         LogNotice("TMPDIR is set to: %@", os.getenv("TMPDIR"))
         self.delegate.buildStartingWithOutput_(self.outputPath())
+        self.progressThrottle.reset()
+        self.buildStartTime = time.time()
         
         self.createTempDir()
         LogDebug("Created temporary directory at %@", self.tempDir)
@@ -441,46 +453,44 @@ class IEDWorkflow(NSObject):
             self.fail_details_("Couldn't save template to tempdir", error)
             return
         
+        self.prepareLayeredBuild()
+        
         # The workflow is split into tasks, and each task has one or more
         # phases. Each phase of the installation is given a weight for the
         # progress bar, calculated from the size of the installer package.
-        # Phases that don't install packages get an estimated weight.
+        # Phases that don't install packages get an estimated weight. Once
+        # earlier builds have recorded how long each phase took, the weights
+        # are derived from those timings instead.
         
         self.tasks = list()
         
+        # Look for an identical earlier build.
+        self.buildCache = IEDBuildCache.alloc().init()
+        self.buildKey = None
+        self.buildCacheHit = False
+        if self.buildCache.isEnabled():
+            self.tasks.append({
+                "title": "Check cache",
+                "method": self.taskCheckCache,
+                "phases": [
+                    {"title": "Checking build cache", "key": "Checking build cache", "weight": 34 * 1024 * 1024},
+                ],
+            })
+        
         # Prepare for install.
         self.tasks.append({
             "title": "Prepare",
             "method": self.taskPrepare,
             "phases": [
-                {"title": "Preparing", "weight": 34 * 1024 * 1024},
+                {"title": "Preparing", "key": "Preparing", "weight": 34 * 1024 * 1024},
             ],
         })
         
         # Perform installation.
-        installerPhases = [
-            {"title": "Starting install",    "weight":       21 * 1024 * 1024},
-            {"title": "Creating disk image", "weight":       21 * 1024 * 1024},
-        ]
-        if self.sourceType != IEDWorkflow.SYSTEM_IMAGE:
-            installerPhases.append({
-                "title": "Installing OS",
-                "weight": 4 * 1024 * 1024 * 1024,
-            })
-        for package in self.additionalPackages:
-            installerPhases.append({
-                "title": "Installing %s" % package.name(),
-                # Add 100 MB to the weight to account for overhead.
-                "weight": package.size() + 100 * 1024 * 1024,
-            })
-        installerPhases.extend([
-            # hdiutil convert.
-            {"title": "Converting disk image", "weight": 313 * 1024 * 1024},
-        ])
         self.tasks.append({
             "title": "Install",
             "method": self.taskInstall,
-            "phases": installerPhases,
+            "phases": self.installPhases(),
         })
 
         # Finalize image. (Skip adding this task if Finalize: Scan for restore is unchecked.)
@@ -489,10 +499,21 @@ class IEDWorkflow(NSObject):
                 "title": "Finalize",
                 "method": self.taskFinalize,
                 "phases": [
-                    {"title": "Scanning disk image", "weight":   2 * 1024 * 1024},
-                    {"title": "Scanning disk image", "weight":   1 * 1024 * 1024},
-                    {"title": "Scanning disk image", "weight": 150 * 1024 * 1024},
-                    {"title": "Scanning disk image", "weight":  17 * 1024 * 1024, "optional": True},
+                    {"title": "Scanning disk image", "key": "Scanning disk image 1", "weight":   2 * 1024 * 1024},
+                    {"title": "Scanning disk image", "key": "Scanning disk image 2", "weight":   1 * 1024 * 1024},
+                    {"title": "Scanning disk image", "key": "Scanning disk image 3", "weight": 150 * 1024 * 1024},
+                    {"title": "Scanning disk image", "key": "Scanning disk image 4", "weight":  17 * 1024 * 1024,
+                     "optional": True},
+                ],
+            })
+        
+        # Store the image in the build cache.
+        if self.buildCache.isEnabled():
+            self.tasks.append({
+                "title": "Store",
+                "method": self.taskStoreInCache,
+                "phases": [
+                    {"title": "Storing in build cache", "key": "Storing in build cache", "weight": 313 * 1024 * 1024},
                 ],
             })
         
@@ -501,10 +522,17 @@ class IEDWorkflow(NSObject):
             "title": "Finish",
             "method": self.taskFinish,
             "phases": [
-                {"title": "Finishing", "weight": 1 * 1024 * 1024},
+                {"title": "Finishing", "key": "Finishing", "weight": 1 * 1024 * 1024},
             ],
         })
         
+        # Replace the estimated weights with what earlier builds took.
+        self.telemetry = IEDBuildTelemetry.alloc().init()
+        phases = list(phase for task in self.tasks for phase in task["phases"])
+        self.telemetry.learnWeightsForPhases_(phases)
+        self.phaseTimings = list()
+        self.eta = IEDBuildETA.alloc().initWithPhases_(phases)
+        
         # Calculate total weight of all phases.
         self.totalWeight = 0
         for task in self.tasks:
@@ -520,6 +548,133 @@ class IEDWorkflow(NSObject):
         self.currentPhase = None
         self.nextTask()
     
+    def installPhases(self):
+        phases = [
+            {"title": "Starting install",    "key": "Starting install",    "weight": 21 * 1024 * 1024},
+            {"title": "Creating disk image", "key": "Creating disk image", "weight": 21 * 1024 * 1024},
+        ]
+        if self.sourceType != IEDWorkflow.SYSTEM_IMAGE and not self.layeredBaseExists:
+            phases.append({
+                "title": "Installing OS",
+                "key": "Installing OS",
+                "weight": 4 * 1024 * 1024 * 1024,
+            })
+        for index, package in enumerate(self.additionalPackages):
+            if self.layeredBaseExists and index < self.layeredBaseCount - 1:
+                # Already installed in the base image.
+                continue
+            phases.append({
+                "title": "Installing %s" % package.name(),
+                # All packages share a key, and are fitted by size.
+                "key": "Installing package",
+                "bytes": package.size(),
+                # Add 100 MB to the weight to account for overhead.
+                "weight": package.size() + 100 * 1024 * 1024,
+            })
+        phases.extend([
+            # hdiutil convert.
+            {"title": "Converting disk image", "key": "Converting disk image", "weight": 313 * 1024 * 1024},
+        ])
+        return phases
+    
+    
+    
+    # Layered builds.
+    #
+    # With LayeredBuilds enabled, the OS and the updates of an InstallESD
+    # build are installed into a base image that is kept in the application
+    # support directory, keyed by the installer build, the update sha1s and
+    # the image parameters. Builds that share a base only install their
+    # additional packages, into a shadow file on top of it.
+    
+    def prepareLayeredBuild(self):
+        self.layeredBasePath = None
+        self.layeredBaseCount = 0
+        self.layeredBaseExists = False
+        
+        defaults = NSUserDefaults.standardUserDefaults()
+        if not defaults.boolForKey_("LayeredBuilds"):
+            return
+        if self.sourceType != IEDWorkflow.INSTALL_ESD:
+            LogInfo("Layered builds require an InstallESD source, building without a base image")
+            return
+        
+        # Updates have a sha1 and come before the other packages.
+        sha1s = list()
+        for package in self.additionalPackages:
+            if not package.sha1():
+                break
+            sha1s.append(package.sha1())
+        keyParts = [self.installerBuild, self.filesystem(), unicode(self.volumeSize() or "auto")] + sha1s
+        key = hashlib.sha1("\n".join(keyParts).encode("utf-8")).hexdigest()
+        
+        baseDir = self.layeredBaseDirectory()
+        try:
+            if not os.path.exists(baseDir):
+                os.makedirs(baseDir)
+        except OSError as e:
+            LogWarning("Can't create %@, building without a base image: %@", baseDir, unicode(e))
+            return
+        self.layeredBasePath = os.path.join(baseDir, "%s.sparseimage" % key)
+        # The OS install and the updates.
+        self.layeredBaseCount = 1 + len(sha1s)
+        self.layeredBaseExists = os.path.exists(self.layeredBasePath)
+        if self.layeredBaseExists:
+            LogNotice("Using base image %@", self.layeredBasePath)
+        else:
+            LogNotice("Creating base image %@ with %d packages", self.layeredBasePath, self.layeredBaseCount)
+    
+    def abandonLayeredBuild(self):
+        """Build without a base image after all. Called from the Prepare
+        task, after the tasks have been planned."""
+        
+        baseExisted = self.layeredBaseExists
+        self.layeredBasePath = None
+        self.layeredBaseCount = 0
+        self.layeredBaseExists = False
+        if not baseExisted:
+            return
+        # The OS and the updates were left out of the install, so plan it
+        # again and update the weights of the remaining phases.
+        for task in self.tasks:
+            if task["title"] == "Install":
+                task["phases"] = self.installPhases()
+        phases = list(phase for task in self.tasks for phase in task["phases"])
+        self.telemetry.learnWeightsForPhases_(phases)
+        self.totalWeight = self.progress + self.currentPhase["weight"] + sum(phase["weight"] for phase in phases)
+        self.delegate.buildSetTotalWeight_(self.totalWeight)
+        self.eta = IEDBuildETA.alloc().initWithPhases_(phases)
+        self.eta.startPhase_(self.currentPhase)
+    
+    def layeredBaseDirectory(self):
+        fm = NSFileManager.defaultManager()
+        url, error = fm.URLForDirectory_inDomain_appropriateForURL_create_error_(NSApplicationSupportDirectory,
+                                                                                 NSUserDomainMask,
+                                                                                 None,
+                                                                                 True,
+                                                                                 None)
+        return os.path.join(url.path(), "AutoDMG", "BaseImages")
+    
+    def pruneLayeredBases(self):
+        # Base images are large, keep only the most recently created ones.
+        # This runs once the script has saved the base of this build, so a
+        # build that fails early doesn't remove the bases it could reuse.
+        maxBases = max(1, NSUserDefaults.standardUserDefaults().integerForKey_("LayeredBuildMaxBaseImages"))
+        baseDir = os.path.dirname(self.layeredBasePath)
+        bases = list()
+        for name in os.listdir(baseDir):
+            path = os.path.join(baseDir, name)
+            if name.endswith(".sparseimage") and path != self.layeredBasePath:
+                bases.append((os.path.getmtime(path), path))
+        bases.sort(reverse=True)
+        # Make room for the base of this build.
+        for mtime, path in bases[maxBases - 1:]:
+            LogInfo("Removing base image %@", path)
+            try:
+                os.unlink(path)
+            except OSError as e:
+                LogWarning("Can't remove base image %@: %@", path, unicode(e))
+    
     
     
     # Task and phase logic.
@@ -542,19 +697,29 @@ class IEDWorkflow(NSObject):
             self.currentTask["method"]()
             LogDebug("Returned from %@()", self.currentTask["title"])
         else:
+            self.finishPhase()
             LogNotice("Build finished successfully, image saved to %@", self.outputPath())
+            # Builds that reused an image or a base image skip most of the
+            # work, and would skew the estimates for full builds.
+            if not self.buildCacheHit and not self.layeredBaseExists:
+                self.recordTelemetry()
             self.delegate.buildSucceeded()
             self.stop()
     
+    def recordTelemetry(self):
+        self.telemetry.recordBuild_({
+            "InstallerBuild": self.installerBuild,
+            "Seconds": time.time() - self.buildStartTime,
+            "PackageBytes": sum(package.size() or 0 for package in self.additionalPackages),
+            "Phases": self.phaseTimings,
+        })
+    
     def nextPhase(self):
         LogDebug("nextPhase, currentPhase == %@", self.currentPhase)
         
         if self.currentPhase:
             self.progress += self.currentPhase["weight"]
-            LogInfo("Phase %@ with weight %ld finished after %.3f seconds",
-                    self.currentPhase["title"],
-                    self.currentPhase["weight"],
-                    time.time() - self.phaseStartTime)
+            self.finishPhase()
         self.phaseStartTime = time.time()
         try:
             self.currentPhase = self.currentTask["phases"].pop(0)
@@ -562,9 +727,33 @@ class IEDWorkflow(NSObject):
             self.fail_details_("No phase left in task", traceback.format_stack())
             return
         LogNotice("Starting phase: %@", self.currentPhase["title"])
+        self.eta.startPhase_(self.currentPhase)
         self.delegate.buildSetPhase_(self.currentPhase["title"])
+        self.reportRemainingTime()
         self.delegate.buildSetProgress_(self.progress)
     
+    def reportRemainingTime(self):
+        self.delegate.buildSetRemainingSeconds_throughput_(self.eta.remainingSeconds(), self.eta.bytesPerSecond())
+    
+    def finishPhase(self):
+        seconds = time.time() - self.phaseStartTime
+        LogInfo("Phase %@ with weight %ld finished after %.3f seconds",
+                self.currentPhase["title"],
+                self.currentPhase["weight"],
+                seconds)
+        expected = self.currentPhase.get("expectedSeconds")
+        if expected and seconds > 60.0 and seconds > 1.5 * expected:
+            LogWarning("Phase %@ took %.0f seconds, previous builds took %.0f seconds",
+                       self.currentPhase["title"], seconds, expected)
+        timing = {
+            "Key": self.currentPhase["key"],
+            "Title": self.currentPhase["title"],
+            "Seconds": seconds,
+        }
+        if self.currentPhase.get("bytes") is not None:
+            timing["Bytes"] = self.currentPhase["bytes"]
+        self.phaseTimings.append(NSDictionary.dictionaryWithDictionary_(timing))
+    
     def fail_details_(self, message, text):
         LogError("Workflow failed: %@ (%@)", message, text)
         self.delegate.buildFailed_details_(message, text)
@@ -574,12 +763,66 @@ class IEDWorkflow(NSObject):
     # or failed.
     def stop(self):
         LogDebug("Workflow stopping")
+        if self.layeredBasePath and not self.layeredBaseExists and os.path.exists(self.layeredBasePath):
+            self.pruneLayeredBases()
         self.deleteTempDir()
         self.detachInstallerDMGs()
         self.delegate.buildStopped()
     
     
     
+    # Task: Check cache.
+    #
+    #    1. Compute a key from everything that goes into the build.
+    #    2. If the build cache has a verified image with that key, link or
+    #       copy it to the output path and skip to the Finish task.
+    
+    def taskCheckCache(self):
+        LogDebug("taskCheckCache")
+        self.performSelectorInBackground_withObject_(self.checkCacheInBackground_, None)
+    
+    def buildInputs(self):
+        bundleVersion = NSBundle.mainBundle().objectForInfoDictionaryKey_("CFBundleVersion") or ""
+        inputs = [
+            "AutoDMG %s" % bundleVersion,
+            "Installer %s %s %s" % (self.installerName, self.installerVersion, self.installerBuild),
+            "VolumeName %s" % self.volumeName(),
+            "VolumeSize %s" % (self.volumeSize() or "auto"),
+            "Filesystem %s" % self.filesystem(),
+            "FinalizeAsrImagescan %s" % self._finalizeAsrImagescan,
+            "Template %s" % self.buildCache.identityForTemplateAtPath_(self.templatePath),
+        ]
+        for package in self.additionalPackages:
+            inputs.append("Package %s" % self.buildCache.identityForPackage_(package))
+        return inputs
+    
+    def checkCacheInBackground_(self, ignored):
+        result = dict()
+        try:
+            key = self.buildCache.keyForInputs_(self.buildInputs())
+            result["key"] = key
+            LogInfo("Build key is %@", key)
+            cachedPath = self.buildCache.lookupKey_(key)
+            if cachedPath:
+                self.buildCache.linkOrCopy_toPath_(cachedPath, self.outputPath())
+                result["cachedPath"] = cachedPath
+        except BaseException as e:
+            result["error"] = unicode(e)
+        self.performSelectorOnMainThread_withObject_waitUntilDone_(self.checkCacheDone_, result, False)
+    
+    def checkCacheDone_(self, result):
+        if "error" in result:
+            # The cache is an optimization, build without it.
+            LogWarning("Build cache check failed: %@", result["error"])
+        self.buildKey = result.get("key")
+        if "cachedPath" in result:
+            LogNotice("Reusing identical build %@", result["cachedPath"])
+            self.buildCacheHit = True
+            self.tasks = list(task for task in self.tasks if task["title"] == "Finish")
+        self.nextTask()
+    
+    
+    
     # Task: Prepare.
     #
     #    1. Go through the list of packages to install and if they're
@@ -655,8 +898,9 @@ class IEDWorkflow(NSObject):
         
         # Calculate disk image size requirements.
         sizeRequirement = 0
+        baseSizeRequirement = 0
         LogInfo("%d packages to install:", len(self.packagesToInstall))
-        for path in self.packagesToInstall:
+        for index, path in enumerate(self.packagesToInstall):
             try:
                 installedSize = IEDUtil.getInstalledPkgSize_(path)
             except BaseException as e:
@@ -669,13 +913,26 @@ class IEDWorkflow(NSObject):
                 return
             LogInfo("    %@ requires %@", path, IEDUtil.formatByteSize_(installedSize))
             sizeRequirement += installedSize
+            if index < self.layeredBaseCount:
+                baseSizeRequirement += installedSize
         sizeReqStr = IEDUtil.formatByteSize_(sizeRequirement)
         LogInfo("Workflow requires a %@ disk image", sizeReqStr)
         
         if self.volumeSize() is None:
             # Calculate DMG size. Multiply package requirements by 1.1, round
-            # to the nearest GB, and add 23.
-            self.setVolumeSize_(int((float(sizeRequirement) * 1.1) / (1000.0 * 1000.0 * 1000.0) + 23.5))
+            # to the nearest GB, and add 23. A base image is sized for its own
+            # packages, so it's the same for all builds that share it, and
+            # builds whose packages need a larger image don't use it.
+            def imageSize(requirement):
+                return int((float(requirement) * 1.1) / (1000.0 * 1000.0 * 1000.0) + 23.5)
+            if self.layeredBasePath and imageSize(sizeRequirement) > imageSize(baseSizeRequirement):
+                LogNotice("Workflow requires a %d GB disk image and the base image is %d GB, building without it",
+                          imageSize(sizeRequirement), imageSize(baseSizeRequirement))
+                self.abandonLayeredBuild()
+            if self.layeredBasePath:
+                self.setVolumeSize_(imageSize(baseSizeRequirement))
+            else:
+                self.setVolumeSize_(imageSize(sizeRequirement))
         else:
             # Make sure user specified image size is large enough.
             if sizeRequirement > self.volumeSize() * 1000 * 1000 * 1000:
@@ -717,6 +974,9 @@ class IEDWorkflow(NSObject):
         ]
         if self.sourceType == IEDWorkflow.SYSTEM_IMAGE:
             args.extend(["--baseimage", self.source()])
+        elif self.layeredBasePath:
+            args.extend(["--layer-base", self.layeredBasePath,
+                         "--layer-count", str(self.layeredBaseCount)])
         args.extend(self.packagesToInstall)
         LogInfo("Launching install with arguments:")
         for arg in args:
@@ -847,6 +1107,33 @@ class IEDWorkflow(NSObject):
     
     
     
+    # Task: Store.
+    #
+    #    1. Add the image to the build cache under the build key, for later
+    #       identical builds.
+    
+    def taskStoreInCache(self):
+        LogDebug("taskStoreInCache")
+        if not self.buildKey:
+            self.nextTask()
+            return
+        self.performSelectorInBackground_withObject_(self.storeInCacheInBackground_, None)
+    
+    def storeInCacheInBackground_(self, ignored):
+        try:
+            error = self.buildCache.storeImage_forKey_(self.outputPath(), self.buildKey)
+        except BaseException as e:
+            error = unicode(e)
+        self.performSelectorOnMainThread_withObject_waitUntilDone_(self.storeInCacheDone_, error, False)
+    
+    def storeInCacheDone_(self, error):
+        if error:
+            # The image is built, so this doesn't fail the build.
+            LogWarning("%@", error)
+        self.nextTask()
+    
+    
+    
     # Task: Finish
     #
     #    1. Just a dummy task to keep the progress bar from finishing
@@ -866,7 +1153,12 @@ class IEDWorkflow(NSObject):
         if action == "update_progress":
             percent = msg["percent"]
             currentProgress = self.progress + self.currentPhase["weight"] * percent / 100.0
-            self.delegate.buildSetProgress_(currentProgress)
+            self.eta.updateFraction_(percent / 100.0)
+            # Helper scripts report progress far more often than it's worth
+            # redrawing, phase changes are always passed on.
+            if self.progressThrottle.shouldReportProgress_ofTotal_forKey_(currentProgress, self.totalWeight, "build"):
+                self.reportRemainingTime()
+                self.delegate.buildSetProgress_(currentProgress)
         
         elif action == "update_message":
             if self.lastUpdateMessage != msg["message"]:
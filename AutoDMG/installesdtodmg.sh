@@ -15,6 +15,11 @@
 #   installesdtodmg.sh ladmin staff HFS+J output.dmg "Macintosh HD" 32 \
 #       /tmp/template.adtmpl \
 #       "/Volumes/OS X Install ESD/Packages/OSInstall.mpkg" [package.pkg ...]
+#
+# For a layered build, pass --layer base.sparseimage count before the
+# packages. The first count packages are installed into the base image,
+# which is saved, and the rest into a shadow file on top of it. If the base
+# image already exists the first count packages are skipped.
 
 
 declare -r TESTING="no"
@@ -129,6 +134,10 @@ template="$7"
 if [[ "$8" == *.dmg ]]; then
     sysimg="$8"
     shift 8
+elif [[ "$8" == "--layer" ]]; then
+    basedmg="$9"
+    declare -i basecount="${10}"
+    shift 10
 else
     shift 7
 fi
@@ -163,6 +172,54 @@ read_nvb() {
 start_nvb=""
 
 
+# Attach an image with a shadow file, so the image itself isn't modified.
+attach_shadow() {
+    local image="$1"
+    echo "IED:MSG:Creating shadow file"
+    
+    shadowfile="$tempdir/autodmg.shadow"
+    shadowoutput=$(hdiutil attach -shadow "$shadowfile" -nobrowse -noautoopen -noverify -owners on "$image")
+    declare -i result=$?
+    if [[ $result -ne 0 ]]; then
+        echo "IED:FAILURE:Failed to create shadow image for install, return code $result."
+        exit 101
+    fi
+    targetdev=$(echo "$shadowoutput" | egrep '/Volumes/' | head -1 | awk '{print $1}')
+    echo "IED:MSG:Renaming $targetdev to $volname"
+    if ! diskutil rename "$targetdev" "$volname"; then
+        echo "IED:FAILURE:Failed to rename install volume."
+        exit 101
+    fi
+    sparsemount=$(egrep '/Volumes/' <<< "$shadowoutput" | head -1 | cut -f3)
+    dmgmounts+=( $(egrep 'Apple_(H|AP)FS' <<< "$shadowoutput" | awk '{print $1}') )
+}
+
+# Save the sparse image as the base image of a layered build, and continue
+# with a shadow file on top of it.
+save_base_image() {
+    echo "IED:MSG:Saving base image"
+    unmount_volume "$sparsemount"
+    unmount_dmgs
+    # Move it into place atomically, so an interrupted build doesn't leave a
+    # partial base image behind.
+    if ! mv "$sparsedmg" "$basedmg.partial" || ! mv "$basedmg.partial" "$basedmg"; then
+        rm -f "$basedmg.partial"
+        echo "IED:FAILURE:Failed to save base image to $basedmg."
+        exit 101
+    fi
+    sysimg="$basedmg"
+    attach_shadow "$sysimg"
+}
+
+# A layered build with an existing base image starts on top of it.
+if [[ -n "$basedmg" && -e "$basedmg" ]]; then
+    echo "IED:MSG:Using base image $basedmg"
+    sysimg="$basedmg"
+    shift $basecount
+    basedmg=""
+fi
+
+
 # Create and mount a sparse image.
 echo "IED:PHASE:sparseimage"
 if [[ -z "$sysimg" ]]; then
@@ -182,23 +239,7 @@ if [[ -z "$sysimg" ]]; then
     touch "$sparsemount/.workaround-mojave-b4-installer-bug"
     dmgmounts+=( $(egrep 'Apple_(H|AP)FS' <<< "$mountoutput" | awk '{print $1}') )
 else
-    echo "IED:MSG:Creating shadow file"
-    
-    shadowfile="$tempdir/autodmg.shadow"
-    shadowoutput=$(hdiutil attach -shadow "$shadowfile" -nobrowse -noautoopen -noverify -owners on "$sysimg")
-    declare -i result=$?
-    if [[ $result -ne 0 ]]; then
-        echo "IED:FAILURE:Failed to create shadow image for install, return code $result."
-        exit 101
-    fi
-    targetdev=$(echo "$shadowoutput" | egrep '/Volumes/' | head -1 | awk '{print $1}')
-    echo "IED:MSG:Renaming $targetdev to $volname"
-    if ! diskutil rename "$targetdev" "$volname"; then
-        echo "IED:FAILURE:Failed to rename install volume."
-        exit 101
-    fi
-    sparsemount=$(egrep '/Volumes/' <<< "$shadowoutput" | head -1 | cut -f3)
-    dmgmounts+=( $(egrep 'Apple_(H|AP)FS' <<< "$shadowoutput" | awk '{print $1}') )
+    attach_shadow "$sysimg"
     # If we're using a system image as the source, read the version and build
     # numbers before the first install.
     start_nvb=$(read_nvb "$sparsemount")
@@ -262,6 +303,10 @@ for package; do
     if [[ -z "$start_nvb" ]]; then
         start_nvb=$(read_nvb "$sparsemount")
     fi
+    if [[ -n "$basedmg" && $pkgnum -eq $basecount ]]; then
+        save_base_image
+        basedmg=""
+    fi
 done
 if [[ $TESTING == "yes" ]]; then
     start_nvb="Mac OS X/9.0/53X248"
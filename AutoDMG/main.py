@@ -91,16 +91,17 @@ def cli_main(argv):
     IEDLog.IEDLogToStdOut      = True
     IEDLog.IEDLogToFile        = False
     
+    # Initialize user defaults before the controller, as it prunes the update
+    # cache on init.
+    defaults = NSUserDefaults.standardUserDefaults()
+    defaultsPath = NSBundle.mainBundle().pathForResource_ofType_("Defaults", "plist")
+    defaultsDict = NSDictionary.dictionaryWithContentsOfFile_(defaultsPath)
+    defaults.registerDefaults_(defaultsDict)
+    
     from IEDCLIController import IEDCLIController
     clicontroller = IEDCLIController.alloc().init()
     
     try:
-        # Initialize user defaults before application starts.
-        defaults = NSUserDefaults.standardUserDefaults()
-        defaultsPath = NSBundle.mainBundle().pathForResource_ofType_("Defaults", "plist")
-        defaultsDict = NSDictionary.dictionaryWithContentsOfFile_(defaultsPath)
-        defaults.registerDefaults_(defaultsDict)
-        
         p = argparse.ArgumentParser()
         p.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
         p.add_argument("-L", "--log-level",
@@ -112,8 +113,9 @@ def cli_main(argv):
         
         # Populate subparser for each verb.
         for verb in clicontroller.listVerbs():
-            verb_method = getattr(clicontroller, "cmd%s_" % verb.capitalize())
-            addargs_method = getattr(clicontroller, "addargs%s_" % verb.capitalize())
+            name = "".join(part.capitalize() for part in verb.split("-"))
+            verb_method = getattr(clicontroller, "cmd%s_" % name)
+            addargs_method = getattr(clicontroller, "addargs%s_" % name)
             parser = sp.add_parser(verb, help=verb_method.__doc__)
             addargs_method(parser)
             parser.set_defaults(func=verb_method)
@@ -311,6 +311,8 @@ def installesdtodmg(args):
         os.chdir(args.cd)
     if args.baseimage:
         baseimage = [args.baseimage]
+    elif args.layer_base:
+        baseimage = ["--layer", args.layer_base, str(args.layer_count)]
     else:
         baseimage = []
     pwargs = ["./installesdtodmg.sh",
@@ -351,6 +353,8 @@ def main(argv):
     iedparser.add_argument("-n", "--volume-name", default="Macintosh HD", help="Set installed system's volume name.")
     iedparser.add_argument("-s", "--size", default="32", help="Disk image size in GB.")
     iedparser.add_argument("-b", "--baseimage", default=None, help="Base system image for shadow mount.")
+    iedparser.add_argument("-l", "--layer-base", default=None, help="Cached base image for a layered build.")
+    iedparser.add_argument("-c", "--layer-count", type=int, default=0, help="Number of packages in the base image.")
     iedparser.add_argument("packages", help="Packages to install", nargs="+")
     iedparser.set_defaults(func=installesdtodmg)
     
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+#  test_IEDBuildCache.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDMG"))
+
+from IEDBuildCache import *
+from IEDTemplate import *
+
+
+class TestBuildCacheTemplateKey(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cache = IEDBuildCache.alloc().init()
+        self.cache.path = os.path.join(self.tempDir, "cache")
+        self.template = IEDTemplate.alloc().init()
+        self.template.setOutputPath_(os.path.join(self.tempDir, "first.dmg"))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+    
+    def keyForTemplate(self):
+        # The other inputs stay the same, so only the template can change the
+        # key.
+        path = os.path.join(self.tempDir, "template.adtmpl")
+        self.assertIsNone(self.template.saveTemplateAndReturnError_(path))
+        return self.cache.keyForInputs_([
+            "Installer Install macOS 10.13.6 17G65",
+            "Template %s" % self.cache.identityForTemplateAtPath_(path),
+        ])
+    
+    def storeImageForKey_(self, key):
+        imagePath = os.path.join(self.tempDir, "image.dmg")
+        with open(imagePath, "wb") as f:
+            f.write(b"image")
+        self.assertIsNone(self.cache.storeImage_forKey_(imagePath, key))
+    
+    def test_unchanged_template_hits(self):
+        key = self.keyForTemplate()
+        self.storeImageForKey_(key)
+        self.assertEqual(self.keyForTemplate(), key)
+        self.assertIsNotNone(self.cache.lookupKey_(key))
+    
+    def test_changed_output_path_misses(self):
+        key = self.keyForTemplate()
+        self.storeImageForKey_(key)
+        self.template.setOutputPath_(os.path.join(self.tempDir, "second.dmg"))
+        changedKey = self.keyForTemplate()
+        self.assertNotEqual(changedKey, key)
+        self.assertIsNone(self.cache.lookupKey_(changedKey))
+    
+    def test_changed_apply_updates_misses(self):
+        key = self.keyForTemplate()
+        self.storeImageForKey_(key)
+        self.template.setApplyUpdates_(True)
+        changedKey = self.keyForTemplate()
+        self.assertNotEqual(changedKey, key)
+        self.assertIsNone(self.cache.lookupKey_(changedKey))
+
+
+if __name__ == "__main__":
+    unittest.main()
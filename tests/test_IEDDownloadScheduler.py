@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+#  test_IEDDownloadScheduler.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDMG"))
+
+from IEDDownloadScheduler import *
+
+
+def minute(hour, minute):
+    return hour * 60 + minute
+
+
+class TestDownloadWindows(unittest.TestCase):
+    
+    def setUp(self):
+        self.scheduler = IEDDownloadScheduler.alloc().initWithRateLimit_(0)
+        self.scheduler.windows = list()
+    
+    def test_parse_windows(self):
+        windows = self.scheduler.parseWindows_(["22:00-06:00", " 9:30 - 17:45 ", "0:00-23:59"])
+        self.assertEqual(windows, [(minute(22, 0), minute(6, 0)),
+                                   (minute(9, 30), minute(17, 45)),
+                                   (minute(0, 0), minute(23, 59))])
+    
+    def test_parse_rejects_invalid_windows(self):
+        for window in ("25:00-99:99", "12:60-13:00", "08:00-24:00", "23:00-06:75", "noon-1", "8-17", ""):
+            self.assertEqual(self.scheduler.parseWindows_([window]), [], window)
+    
+    def test_parse_keeps_valid_windows(self):
+        windows = self.scheduler.parseWindows_(["25:00-99:99", "01:00-02:00"])
+        self.assertEqual(windows, [(minute(1, 0), minute(2, 0))])
+    
+    def test_no_windows(self):
+        self.assertFalse(self.scheduler.hasWindows())
+        for m in (0, minute(12, 0), minute(23, 59)):
+            self.assertTrue(self.scheduler.isInWindowAtMinute_(m))
+        self.assertIsNone(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(12, 0), 0))
+    
+    def test_window_within_day(self):
+        self.scheduler.windows = [(minute(9, 0), minute(17, 0))]
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(8, 59)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(9, 0)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(16, 59)))
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(17, 0)))
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(0, 0)))
+    
+    def test_window_past_midnight(self):
+        self.scheduler.windows = [(minute(22, 0), minute(6, 0))]
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(21, 59)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(22, 0)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(23, 59)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(0, 0)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(5, 59)))
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(6, 0)))
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(12, 0)))
+    
+    def test_window_start_equals_end(self):
+        # A window that starts when it ends covers the whole day.
+        self.scheduler.windows = [(minute(3, 0), minute(3, 0))]
+        for m in (0, minute(2, 59), minute(3, 0), minute(23, 59)):
+            self.assertTrue(self.scheduler.isInWindowAtMinute_(m))
+        self.assertIsNone(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(12, 0), 0))
+    
+    def test_several_windows(self):
+        self.scheduler.windows = [(minute(1, 0), minute(2, 0)), (minute(13, 0), minute(14, 0))]
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(1, 30)))
+        self.assertFalse(self.scheduler.isInWindowAtMinute_(minute(7, 0)))
+        self.assertTrue(self.scheduler.isInWindowAtMinute_(minute(13, 30)))
+    
+    def test_seconds_until_window_closes(self):
+        self.scheduler.windows = [(minute(9, 0), minute(17, 0))]
+        self.assertEqual(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(10, 0), 0), 7 * 3600)
+        self.assertEqual(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(16, 59), 30), 30)
+    
+    def test_seconds_until_window_opens(self):
+        self.scheduler.windows = [(minute(9, 0), minute(17, 0))]
+        self.assertEqual(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(8, 0), 0), 3600)
+        # Waiting past midnight.
+        self.assertEqual(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(23, 0), 0), 10 * 3600)
+    
+    def test_seconds_until_window_past_midnight_closes(self):
+        self.scheduler.windows = [(minute(22, 0), minute(6, 0))]
+        self.assertEqual(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(23, 0), 0), 7 * 3600)
+        self.assertEqual(self.scheduler.secondsUntilWindowChangeAtMinute_second_(minute(12, 0), 0), 10 * 3600)
+
+
+class TestRateLimit(unittest.TestCase):
+    
+    def test_unlimited(self):
+        scheduler = IEDDownloadScheduler.alloc().initWithRateLimit_(0)
+        self.assertEqual(scheduler.delayForBytes_(10 * 1024 * 1024), 0.0)
+    
+    def test_burst_of_one_second(self):
+        scheduler = IEDDownloadScheduler.alloc().initWithRateLimit_(1000)
+        # The bucket starts full.
+        self.assertEqual(scheduler.delayForBytes_(1000), 0.0)
+        self.assertAlmostEqual(scheduler.delayForBytes_(500), 0.5, delta=0.05)
+    
+    def test_refill(self):
+        scheduler = IEDDownloadScheduler.alloc().initWithRateLimit_(1000)
+        scheduler.tokens = 0.0
+        scheduler.lastRefill = time.time() - 0.25
+        self.assertAlmostEqual(scheduler.delayForBytes_(500), 0.25, delta=0.05)
+    
+    def test_refill_is_capped(self):
+        scheduler = IEDDownloadScheduler.alloc().initWithRateLimit_(1000)
+        scheduler.tokens = 0.0
+        # An idle period doesn't allow more than one second's worth.
+        scheduler.lastRefill = time.time() - 60.0
+        self.assertAlmostEqual(scheduler.delayForBytes_(3000), 2.0, delta=0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+#  test_IEDRetryPolicy.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDMG"))
+
+from Foundation import NSError, NSURLErrorDomain, NSPOSIXErrorDomain
+from Foundation import NSURLErrorTimedOut, NSURLErrorNetworkConnectionLost, NSURLErrorCannotConnectToHost
+from Foundation import NSURLErrorBadURL, NSURLErrorUnsupportedURL, NSURLErrorCancelled
+from IEDRetryPolicy import *
+
+
+class TestRetryPolicy(unittest.TestCase):
+    
+    def setUp(self):
+        random.seed(0)
+        self.policy = IEDRetryPolicy.alloc().init()
+        self.policy.maxAttempts = 4
+        self.policy.baseDelay = 2.0
+        self.policy.maxDelay = 10.0
+    
+    def test_retries_until_max_attempts(self):
+        self.assertTrue(self.policy.shouldRetryAttempt_(1))
+        self.assertTrue(self.policy.shouldRetryAttempt_(3))
+        self.assertFalse(self.policy.shouldRetryAttempt_(4))
+        self.assertFalse(self.policy.shouldRetryAttempt_(5))
+    
+    def test_delay_backs_off_up_to_max(self):
+        # The delay before jitter doubles with every attempt and is capped.
+        for attempt, delay in ((1, 2.0), (2, 4.0), (3, 8.0), (4, 10.0), (10, 10.0)):
+            for i in range(100):
+                seconds = self.policy.delayForAttempt_(attempt)
+                self.assertGreaterEqual(seconds, delay / 2.0)
+                self.assertLessEqual(seconds, delay)
+    
+    def test_delay_is_jittered(self):
+        delays = list(self.policy.delayForAttempt_(3) for i in range(200))
+        # Spread over the upper half of the 8 second delay.
+        self.assertLess(min(delays), 4.5)
+        self.assertGreater(max(delays), 7.5)
+        self.assertGreater(len(set(delays)), 100)
+    
+    def test_zero_delay(self):
+        self.policy.baseDelay = 0.0
+        self.assertEqual(self.policy.delayForAttempt_(1), 0.0)
+        self.assertEqual(self.policy.delayForAttempt_(5), 0.0)
+    
+    def test_retryable_statuses(self):
+        for status in (408, 429, 500, 502, 503, 504):
+            self.assertTrue(self.policy.isRetryableStatus_(status), status)
+    
+    def test_fatal_statuses(self):
+        for status in (400, 401, 403, 404, 410, 416):
+            self.assertFalse(self.policy.isRetryableStatus_(status), status)
+    
+    def test_retryable_url_errors(self):
+        for code in (NSURLErrorTimedOut, NSURLErrorNetworkConnectionLost, NSURLErrorCannotConnectToHost):
+            error = NSError.errorWithDomain_code_userInfo_(NSURLErrorDomain, code, None)
+            self.assertTrue(self.policy.isRetryableError_(error), code)
+    
+    def test_fatal_url_errors(self):
+        for code in (NSURLErrorBadURL, NSURLErrorUnsupportedURL, NSURLErrorCancelled):
+            error = NSError.errorWithDomain_code_userInfo_(NSURLErrorDomain, code, None)
+            self.assertFalse(self.policy.isRetryableError_(error), code)
+    
+    def test_other_domains_are_retryable(self):
+        error = NSError.errorWithDomain_code_userInfo_(NSPOSIXErrorDomain, NSURLErrorBadURL, None)
+        self.assertTrue(self.policy.isRetryableError_(error))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+#  test_IEDUpdateDownload.py
+#  AutoDMG
+#
+#  Created by agent on 2026-10-18.
+#  Copyright 2013-2017 Per Olofsson, University of Gothenburg. All rights reserved.
+#
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDMG"))
+
+from IEDPackage import *
+from IEDUpdateDownload import *
+
+
+class TestCache(object):
+    """Stands in for IEDUpdateCache, which keeps .part files in
+    updateDir."""
+    
+    def __init__(self, updateDir):
+        self.updateDir = updateDir
+    
+    def cacheTmpPath_(self, sha1):
+        return os.path.join(self.updateDir, sha1 + ".part")
+
+
+class TestUpdateDownloadSizes(unittest.TestCase):
+    
+    SHA1 = "0123456789abcdef0123456789abcdef01234567"
+    
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        package = IEDPackage.alloc().init()
+        package.setName_("Update")
+        package.setSha1_(self.SHA1)
+        package.setSize_(1000)
+        self.download = IEDUpdateDownload.alloc().initWithPackage_cache_(package, TestCache(self.tempDir))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+    
+    def writePartialFile_(self, size):
+        with open(self.download.tmpPath(), "wb") as f:
+            f.write(b"x" * size)
+    
+    def segment(self, position, done):
+        return {"start": 0, "end": None, "position": position, "connection": None, "fileHandle": None, "done": done}
+    
+    def test_no_partial_file(self):
+        self.assertEqual(self.download.partialSize(), 0)
+    
+    def test_partial_prefix_is_resumed(self):
+        self.writePartialFile_(400)
+        self.assertEqual(self.download.partialSize(), 400)
+    
+    def test_complete_file_starts_over(self):
+        # A file that is already complete failed verification, or it would
+        # have been moved into the cache.
+        self.writePartialFile_(1000)
+        self.assertEqual(self.download.partialSize(), 0)
+    
+    def test_oversized_file_starts_over(self):
+        self.writePartialFile_(1500)
+        self.assertEqual(self.download.partialSize(), 0)
+    
+    def test_contiguous_all_done(self):
+        self.download.segments = [self.segment(250, True), self.segment(500, True), self.segment(1000, True)]
+        self.assertEqual(self.download.contiguousSize(), 1000)
+    
+    def test_contiguous_stops_at_first_gap(self):
+        # Later segments that finished don't count after a gap.
+        self.download.segments = [self.segment(250, True), self.segment(300, False), self.segment(1000, True)]
+        self.assertEqual(self.download.contiguousSize(), 300)
+    
+    def test_contiguous_first_segment_running(self):
+        self.download.segments = [self.segment(100, False), self.segment(500, True)]
+        self.assertEqual(self.download.contiguousSize(), 100)
+    
+    def test_contiguous_no_segments(self):
+        self.download.segments = list()
+        self.assertEqual(self.download.contiguousSize(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()